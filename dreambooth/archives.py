@@ -0,0 +1,153 @@
+"""
+Read training images and captions straight from .zip and .tar archives.
+
+A data directory can be an archive, and its images are then addressed like files in a directory, e.g.
+/data/photos.zip/img001.jpg. Archives are opened lazily and separately in every process, so dataloader workers each
+get their own file handle.
+"""
+import io
+import json
+import os
+import posixpath
+import tarfile
+import types
+import zipfile
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar")
+COMPRESSED_TAR_EXTENSIONS = (".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+# Path prefixes known to be (or not be) archive files, so member paths don't stat their parents on every read.
+_archive_files = {}
+_readers = {}
+
+
+def is_archive(path) -> bool:
+    path = str(path)
+    if path not in _archive_files:
+        lower = path.lower()
+        if lower.endswith(COMPRESSED_TAR_EXTENSIONS) and os.path.isfile(path):
+            raise ValueError(f"Compressed tar archives can't be read without extracting them, repack {path} as a "
+                             f".tar or .zip file.")
+        _archive_files[path] = lower.endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path)
+    return _archive_files[path]
+
+
+def split_member(path) -> Optional[Tuple[str, str]]:
+    """
+    Returns: The archive and member name if path points into an archive, None otherwise.
+    """
+    path = os.path.normpath(str(path))
+    parts = path.split(os.sep)
+    for index in range(1, len(parts)):
+        if parts[index - 1].lower().endswith(ARCHIVE_EXTENSIONS):
+            archive = os.sep.join(parts[:index]) or os.sep
+            if is_archive(archive):
+                return archive, "/".join(parts[index:])
+    return None
+
+
+class ArchiveReader:
+    """
+    Member index and reads of one archive. Zip files index themselves through their central directory. Tar files are
+    scanned once and their member offsets saved next to the archive (or kept in memory if that isn't writable), so
+    reads are a seek and a read.
+    """
+
+    def __init__(self, archive: str):
+        self.archive = archive
+        self.is_zip = archive.lower().endswith(".zip")
+        self.members = None
+        self._handle = None
+        self._pid = None
+
+    def _open(self):
+        # Handles aren't shared between processes, a forked worker opens its own.
+        if self._handle is None or self._pid != os.getpid():
+            self._handle = zipfile.ZipFile(self.archive) if self.is_zip else open(self.archive, "rb")
+            self._pid = os.getpid()
+        return self._handle
+
+    def index(self) -> Dict[str, Tuple[int, int, float]]:
+        """
+        Returns: Member name -> (offset, size, mtime) of every file in the archive. The offset is 0 for zip files.
+        """
+        if self.members is not None:
+            return self.members
+        if self.is_zip:
+            self.members = {info.filename: (0, info.file_size, datetime(*info.date_time).timestamp())
+                            for info in self._open().infolist() if not info.is_dir()}
+            return self.members
+
+        stat = os.stat(self.archive)
+        index_file = f"{self.archive}.index.json"
+        try:
+            with open(index_file, "r") as f:
+                index = json.load(f)
+            if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime:
+                self.members = {name: tuple(member) for name, member in index["members"].items()}
+                return self.members
+        except (OSError, ValueError, KeyError):
+            pass
+        with tarfile.open(self.archive, "r:") as tar:
+            # Names are normalized the way member paths are, "./img.jpg" is looked up as "img.jpg".
+            self.members = {posixpath.normpath(member.name): (member.offset_data, member.size, member.mtime)
+                            for member in tar if member.isfile()}
+        try:
+            with open(index_file, "w") as f:
+                json.dump({"size": stat.st_size, "mtime": stat.st_mtime, "members": self.members}, f)
+        except OSError:
+            pass
+        return self.members
+
+    def read(self, member: str) -> bytes:
+        if self.is_zip:
+            return self._open().read(member)
+        offset, size, _ = self.index()[member]
+        handle = self._open()
+        handle.seek(offset)
+        return handle.read(size)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_handle"] = None
+        return state
+
+
+def get_reader(archive: str) -> ArchiveReader:
+    if archive not in _readers:
+        _readers[archive] = ArchiveReader(archive)
+    return _readers[archive]
+
+
+def read_bytes(path) -> bytes:
+    member = split_member(path)
+    if member is None:
+        with open(path, "rb") as f:
+            return f.read()
+    archive, name = member
+    return get_reader(archive).read(name)
+
+
+def image_source(path):
+    """
+    Returns: Something PIL's Image.open can read: the path itself for regular files, the member's bytes otherwise.
+    """
+    member = split_member(path)
+    if member is None:
+        return path
+    archive, name = member
+    return io.BytesIO(get_reader(archive).read(name))
+
+
+def file_stat(path):
+    """
+    os.stat for regular files. Archive members get their size and mtime from the archive index.
+    """
+    member = split_member(path)
+    if member is None:
+        return os.stat(path)
+    archive, name = member
+    _, size, mtime = get_reader(archive).index()[name]
+    return types.SimpleNamespace(st_size=size, st_mtime=mtime, st_mtime_ns=int(mtime * 1e9))
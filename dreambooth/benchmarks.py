@@ -0,0 +1,133 @@
+"""
+Standalone benchmarks for the dreambooth data pipeline. These don't need the webui, run them from the extension
+directory, e.g.:
+
+    python -m dreambooth.benchmarks decode /path/to/photos --size 512
+    python -m dreambooth.benchmarks samplers /path/to/models/dreambooth/MODELNAME/working --prompt "photo of a dog"
+"""
+import argparse
+import os
+import time
+
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from dreambooth.image_cache import open_image
+
+
+def list_images(directory, limit=None):
+    extensions = Image.registered_extensions()
+    files = [os.path.join(directory, file) for file in sorted(os.listdir(directory))
+             if os.path.splitext(file)[1].lower() in extensions]
+    return files[:limit] if limit else files
+
+
+def benchmark_decode(directory, size=512, limit=None):
+    """
+    Compare decode+resize throughput of full-resolution decoding with reduced-size decoding.
+    Returns: A dict of images/sec per method.
+    """
+    files = list_images(directory, limit)
+    if not len(files):
+        print(f"No images found in {directory}.")
+        return {}
+    resize = transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR)
+
+    def full_decode(image_path):
+        image = Image.open(image_path)
+        if not image.mode == "RGB":
+            image = image.convert("RGB")
+        return resize(image)
+
+    def reduced_decode(image_path):
+        return resize(open_image(image_path, size))
+
+    # Read everything once, so both runs measure decoding rather than disk reads.
+    for file in files:
+        with open(file, "rb") as f:
+            f.read()
+
+    results = {}
+    for name, load in (("full decode", full_decode), ("reduced decode", reduced_decode)):
+        start = time.perf_counter()
+        for file in files:
+            load(file)
+        elapsed = time.perf_counter() - start
+        results[name] = len(files) / elapsed
+        print(f"{name}: {len(files)} images in {elapsed:.2f}s, {results[name]:.1f} images/sec")
+    print(f"Speedup: {results['reduced decode'] / results['full decode']:.2f}x")
+    return results
+
+
+def benchmark_samplers(model_dir, prompt, schedulers, steps_list, batch_size=1, count=4, guidance_scale=7.5,
+                       negative_prompt=None):
+    """
+    Compare class image generation throughput of schedulers and step counts.
+    Returns: A dict of images/sec per (scheduler, steps).
+    """
+    # diffusers is only needed by this benchmark.
+    from diffusers import StableDiffusionPipeline
+    from dreambooth.schedulers import make_scheduler
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    pipeline = StableDiffusionPipeline.from_pretrained(model_dir, torch_dtype=dtype, safety_checker=None)
+    pipeline.set_progress_bar_config(disable=True)
+    pipeline.to(device)
+    model_scheduler = pipeline.scheduler
+    prompts = [prompt] * batch_size
+    kwargs = {"guidance_scale": guidance_scale}
+    if negative_prompt:
+        kwargs["negative_prompt"] = [negative_prompt] * batch_size
+
+    results = {}
+    with torch.inference_mode():
+        for name in schedulers:
+            pipeline.scheduler = make_scheduler(name, model_scheduler.config) or model_scheduler
+            for steps in steps_list:
+                # The first batch warms up kernels and allocations, it isn't timed.
+                pipeline(prompts, num_inference_steps=steps, **kwargs)
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                generated = 0
+                while generated < count:
+                    generated += len(pipeline(prompts, num_inference_steps=steps, **kwargs).images)
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - start
+                results[(name, steps)] = generated / elapsed
+                print(f"{name}, {steps} steps: {generated} images in {elapsed:.2f}s, "
+                      f"{results[(name, steps)]:.2f} images/sec")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dreambooth data pipeline benchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    decode_parser = subparsers.add_parser("decode", help="Decode+resize throughput, full vs reduced-size decoding.")
+    decode_parser.add_argument("directory", type=str, help="A directory of (large) images.")
+    decode_parser.add_argument("--size", type=int, default=512, help="The training resolution.")
+    decode_parser.add_argument("--limit", type=int, default=None, help="Only use the first N images.")
+    samplers_parser = subparsers.add_parser("samplers", help="Class image generation throughput per scheduler.")
+    samplers_parser.add_argument("model_dir", type=str, help="A diffusers model, e.g. a model's working directory.")
+    samplers_parser.add_argument("--prompt", type=str, default="photo of a dog", help="The class prompt.")
+    samplers_parser.add_argument("--negative-prompt", type=str, default=None, help="The class negative prompt.")
+    samplers_parser.add_argument("--schedulers", type=str, nargs="+", default=["default", "ddim", "euler_a", "dpm++"],
+                                 help="The schedulers to compare.")
+    samplers_parser.add_argument("--steps", type=int, nargs="+", default=[20, 50], help="The step counts to compare.")
+    samplers_parser.add_argument("--guidance-scale", type=float, default=7.5, help="The class guidance scale.")
+    samplers_parser.add_argument("--batch-size", type=int, default=1, help="The class batch size.")
+    samplers_parser.add_argument("--count", type=int, default=4, help="How many images to time per setting.")
+    args = parser.parse_args()
+
+    if args.benchmark == "decode":
+        benchmark_decode(args.directory, args.size, args.limit)
+    elif args.benchmark == "samplers":
+        benchmark_samplers(args.model_dir, args.prompt, args.schedulers, args.steps, args.batch_size, args.count,
+                           args.guidance_scale, args.negative_prompt)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import torch
+from PIL import Image
+from diffusers import AutoencoderKL, StableDiffusionPipeline
+from torch.utils.data import Dataset
+from tqdm.auto import tqdm
+
+from dreambooth.archives import is_archive
+from dreambooth.manifest import load_manifest
+from dreambooth.schedulers import WEBUI_SAMPLERS, make_scheduler
+from modules import paths, processing, sd_models, sd_samplers, shared
+
+GENERATION_FILE = "class_generation.json"
+
+
+class PromptDataset(Dataset):
+    "A simple dataset to prepare the prompts to generate class images on multiple GPUs."
+
+    def __init__(self, prompt, filename_texts, num_samples, indices=None):
+        self.prompt = prompt
+        self.filename_texts = filename_texts
+        self.num_samples = num_samples
+        # Only these sample indices are generated, the rest were done before.
+        self.indices = indices
+
+    def __len__(self):
+        return self.num_samples if self.indices is None else len(self.indices)
+
+    def __getitem__(self, index):
+        if self.indices is not None:
+            index = self.indices[index]
+        example = {}
+        example["filename_text"] = self.filename_texts[index % len(self.filename_texts)] if len(self.filename_texts) > 0 else ""
+        example["prompt"] = self.prompt.replace("[filewords]", example["filename_text"])
+        example["index"] = index
+        return example
+
+
+class ImageWriter:
+    """
+    Hashes, JPEG-encodes and saves generated images on a small thread pool, so the GPU moves on to the next batch
+    instead of waiting on them. At most max_pending images are queued, submit() blocks beyond that so a slow disk
+    can't pile up images in memory. Errors are raised from the next submit() or close().
+    """
+
+    def __init__(self, num_threads: int = 2, max_pending: int = 8):
+        self.executor = ThreadPoolExecutor(num_threads, thread_name_prefix="class_images")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.error = None
+        self.saved = 0
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+
+    def _save(self, image, class_images_dir: Path, index: int, filename_text=None):
+        hash_image = hashlib.sha1(image.tobytes()).hexdigest()
+        if filename_text is not None:
+            with open(class_images_dir / f"{index}-{hash_image}.txt", "w", encoding="utf8") as file:
+                # we have to write filename_text and not full prompt here, otherwise "dog, [filewords]" becomes "dog, dog, [filewords]" when read. Any elegant solution?
+                file.write(filename_text + "\n")
+        # Written under a temporary name and renamed, so an image file on disk is always complete.
+        tmp_file = class_images_dir / f"{index}-{hash_image}.jpg.tmp"
+        image.save(tmp_file, format="JPEG")
+        os.replace(tmp_file, class_images_dir / f"{index}-{hash_image}.jpg")
+        self.saved += 1
+
+    def submit(self, image, class_images_dir: Path, index: int, filename_text=None):
+        if self.error is not None:
+            raise self.error
+        self.slots.acquire()
+        self.executor.submit(self._save, image, class_images_dir, index, filename_text).add_done_callback(self._done)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+
+
+class WebuiPipeline:
+    """
+    Generates class images with the model loaded in the webui and its samplers, called like a diffusers pipeline.
+    start_training keeps that model on the CPU while training, it's moved to the GPU until close().
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.model = shared.sd_model
+        # "default" is the model's own scheduler, as it is for the diffusers pipeline.
+        scheduler = args.scheduler if not args.class_scheduler or args.class_scheduler == "default" \
+            else args.class_scheduler
+        name = WEBUI_SAMPLERS.get(scheduler)
+        sampler_names = [sampler.name for sampler in sd_samplers.samplers]
+        if name not in sampler_names:
+            if name is not None:
+                print(f"Sampler {name} isn't available in this webui version, using {sampler_names[0]}.")
+            name = sampler_names[0]
+        self.sampler_name = name
+        self.sampler_index = sampler_names.index(name)
+        self.model.to(shared.device)
+
+    def __call__(self, prompt, height=512, width=512, num_inference_steps=50, guidance_scale=7.5, negative_prompt=None):
+        p = processing.StableDiffusionProcessingTxt2Img(
+            sd_model=self.model,
+            outpath_samples=shared.opts.outdir_txt2img_samples,
+            outpath_grids=shared.opts.outdir_txt2img_grids,
+            prompt=list(prompt),
+            negative_prompt=negative_prompt[0] if negative_prompt else "",
+            batch_size=len(prompt),
+            n_iter=1,
+            steps=num_inference_steps,
+            cfg_scale=guidance_scale,
+            width=width,
+            height=height,
+            do_not_save_samples=True,
+            do_not_save_grid=True,
+        )
+        # Older webui versions pick the sampler by index, newer ones by name.
+        p.sampler_index = self.sampler_index
+        p.sampler_name = self.sampler_name
+        # process_images counts batches in shared.state, sample_images counts images.
+        job_no = shared.state.job_no
+        processed = processing.process_images(p)
+        shared.state.job_no = job_no
+        if shared.state.interrupted:
+            # Sampling stopped part way, these images aren't finished.
+            return types.SimpleNamespace(images=[])
+        return types.SimpleNamespace(images=processed.images[-len(prompt):])
+
+    def close(self):
+        self.model.to("cpu")
+
+
+def webui_model_matches(args) -> bool:
+    """
+    Returns: Whether class images can be generated with the webui's loaded model: it is the source checkpoint, the
+    model wasn't trained yet, and no other VAE was chosen.
+    """
+    if not args.class_use_webui_model or args.total_steps or args.pretrained_vae_name_or_path or not args.src:
+        return False
+    checkpoint = sd_models.get_closet_checkpoint_match(args.src)
+    loaded = getattr(shared.sd_model, "sd_checkpoint_info", None)
+    return checkpoint is not None and loaded is not None and loaded.hash == checkpoint.hash
+
+
+def load_pipeline(args, accelerator):
+    if webui_model_matches(args):
+        print("Generating class images with the webui's loaded model.")
+        return WebuiPipeline(args)
+    torch_dtype = torch.float16 if accelerator.device.type == "cuda" else torch.float32
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        args.working_dir,
+        vae=AutoencoderKL.from_pretrained(
+            args.pretrained_vae_name_or_path or args.working_dir,
+            subfolder=None if args.pretrained_vae_name_or_path else "vae",
+            torch_dtype=torch_dtype
+        ),
+        torch_dtype=torch_dtype,
+        safety_checker=None
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    pipeline.to(accelerator.device)
+    scheduler = make_scheduler(args.class_scheduler, pipeline.scheduler.config)
+    if scheduler is not None:
+        pipeline.scheduler = scheduler
+    return pipeline
+
+
+def sample_images(pipeline, args, accelerator, sample_dataset, out_dir: Path, first_index: int, save_txt: bool) -> bool:
+    """
+    Generate the images of sample_dataset into out_dir, numbering them from first_index.
+    Returns: Whether generation was cancelled. It stops before the next batch, images already sampled are saved.
+    """
+    shared.state.job_count = len(sample_dataset)
+    shared.state.job_no = 0
+    sample_dataloader = torch.utils.data.DataLoader(sample_dataset, batch_size=args.sample_batch_size)
+
+    sample_dataloader = accelerator.prepare(sample_dataloader)
+
+    # Both backends generate at the training resolution, the library is keyed on it.
+    sampler_kwargs = {"height": args.resolution, "width": args.resolution}
+    # Settings left empty in older configs keep the pipeline defaults.
+    if args.class_infer_steps:
+        sampler_kwargs["num_inference_steps"] = int(args.class_infer_steps)
+    if args.class_guidance_scale:
+        sampler_kwargs["guidance_scale"] = float(args.class_guidance_scale)
+    # Two batches can wait on the writer while the next one is sampled.
+    writer = ImageWriter(max_pending=2 * args.sample_batch_size)
+    start = time.perf_counter()
+    progress = tqdm(sample_dataloader, desc="Generating class images",
+                    disable=not accelerator.is_local_main_process)
+    try:
+        with torch.autocast("cuda"), torch.inference_mode():
+            for example in progress:
+                if shared.state.interrupted:
+                    break
+                if args.class_negative_prompt:
+                    # The pipeline wants one negative prompt per prompt.
+                    sampler_kwargs["negative_prompt"] = [args.class_negative_prompt] * len(example["prompt"])
+                images = pipeline(example["prompt"], **sampler_kwargs).images
+
+                for i, image in enumerate(images):
+                    shared.state.job_no += 1
+                    shared.state.current_image = image
+                    writer.submit(image, out_dir, int(example["index"][i]) + first_index,
+                                  example["filename_text"][i] if save_txt else None)
+                images_per_sec = shared.state.job_no / (time.perf_counter() - start)
+                progress.set_postfix(img_s=f"{images_per_sec:.2f}")
+                shared.state.textinfo = f"Generating class images {shared.state.job_no}/{len(sample_dataset)}, " \
+                                        f"{images_per_sec:.2f} images/sec"
+    finally:
+        writer.close()
+    print(f"Generated {writer.saved} class images in {time.perf_counter() - start:.1f}s.")
+    return shared.state.interrupted
+
+
+def read_generation(out_dir: Path) -> Optional[Dict]:
+    try:
+        with open(out_dir / GENERATION_FILE, "r", encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_generation(out_dir: Path, job: Dict):
+    tmp_file = out_dir / f"{GENERATION_FILE}.tmp"
+    with open(tmp_file, "w", encoding="utf8") as f:
+        json.dump(job, f)
+    os.replace(tmp_file, out_dir / GENERATION_FILE)
+
+
+def image_numbers(out_dir: Path) -> Set[int]:
+    # The numbers generated images are named with, "12-<sha1>.jpg" is 12.
+    numbers = set()
+    for name in os.listdir(out_dir):
+        number, _, rest = name.partition("-")
+        if number.isdigit() and rest.endswith(".jpg"):
+            numbers.add(int(number))
+    return numbers
+
+
+def plan_generation(out_dir: Path, prompt: str, num_images: int) -> Tuple[Dict, List[int]]:
+    """
+    Resume the unfinished generation job of out_dir, or start a new one.
+
+    A job is saved as class_generation.json: the class prompt, the number of its first image and how many images it
+    covers. Images are only ever renamed into place complete, so an image with the job's number on disk is done,
+    and a restart generates exactly the numbers that are missing.
+    Returns: The job, and the offsets from its first number still to generate, at most num_images of them.
+    """
+    numbers = image_numbers(out_dir)
+    job = read_generation(out_dir)
+    if job is None or job["prompt"] != prompt:
+        # New images are numbered after every existing one, so they can't be mistaken for other images.
+        job = {"prompt": prompt, "first_index": max(numbers, default=-1) + 1, "count": 0}
+    offsets = []
+    offset = 0
+    while len(offsets) < num_images:
+        if job["first_index"] + offset not in numbers:
+            offsets.append(offset)
+        offset += 1
+    job["count"] = max(job["count"], offset)
+    return job, offsets
+
+
+def library_dir(args, concept) -> Optional[Path]:
+    """
+    The shared class image library folder for a concept's class prompt, keyed on the source checkpoint hash, the
+    prompts, the sampler settings and the resolution.
+    Returns: The folder, or None if images generated for this run can't be shared: the class prompt uses [filewords],
+    which depend on the instance images, or the source checkpoint is unknown.
+    """
+    if not args.class_image_library or "[filewords]" in concept["class_prompt"]:
+        return None
+    checkpoint = sd_models.get_closet_checkpoint_match(args.src) if args.src else None
+    if checkpoint is None:
+        return None
+    settings = {
+        "checkpoint": checkpoint.hash,
+        "vae": args.pretrained_vae_name_or_path,
+        "prompt": concept["class_prompt"],
+        "negative_prompt": args.class_negative_prompt,
+        "scheduler": args.class_scheduler,
+        "steps": args.class_infer_steps,
+        "guidance_scale": args.class_guidance_scale,
+        "resolution": args.resolution,
+    }
+    key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+    folder = Path(paths.models_path, "dreambooth_class_library", key)
+    folder.mkdir(parents=True, exist_ok=True)
+    settings_file = folder / "settings.json"
+    if not settings_file.exists():
+        # Only for finding a library by hand, the folder name is the key.
+        with open(settings_file, "w", encoding="utf8") as f:
+            json.dump(dict(settings, checkpoint_title=checkpoint.title), f, indent=4)
+    return folder
+
+
+def link_images(source_dir: Path, target_dir: Path, count: int) -> int:
+    """
+    Hardlink up to count images of source_dir that target_dir doesn't have yet into it, copying them if the two
+    aren't on the same filesystem.
+    Returns: The number of images added.
+    """
+    existing = set(os.listdir(target_dir))
+    extensions = Image.registered_extensions()
+    # Only names are needed, the library isn't scanned for image sizes like a dataset directory.
+    names = sorted(name for name in os.listdir(source_dir) if os.path.splitext(name)[1] in extensions)
+    added = 0
+    for name in names:
+        if added >= count:
+            break
+        if name in existing:
+            continue
+        try:
+            os.link(source_dir / name, target_dir / name)
+        except FileExistsError:
+            # Another process linked it first.
+            continue
+        except OSError:
+            shutil.copy2(source_dir / name, target_dir / name)
+        added += 1
+    return added
+
+
+def generate_class_images(args, accelerator, manifest_dir, text_getter) -> bool:
+    """
+    Generate the missing class images of every concept, up to args.num_class_images per class directory.
+
+    Class prompts without [filewords] draw from a class image library shared by every model trained from the same
+    source checkpoint with the same sampler settings. Its images are hardlinked into the class directory, and only
+    the shortfall is generated, into the library. A model that was already trained generates into its own class
+    directory, as its weights no longer match the source checkpoint.
+    Args:
+        args: The training config.
+        accelerator: Decides the device, and splits the prompts between processes.
+        manifest_dir: Where directory manifests are stored.
+        text_getter: Reads the [filewords] of instance images, to fill in class prompts that use them.
+
+    Returns: Whether generation was cancelled.
+    """
+    interrupted = False
+    pipeline = None
+    for concept in args.concepts_list:
+        class_images_dir = Path(concept["class_data_dir"])
+        if is_archive(class_images_dir):
+            cur_class_images = len(load_manifest(str(class_images_dir), manifest_dir))
+            if cur_class_images < args.num_class_images:
+                print(f"Class images can't be generated into the archive {class_images_dir}, training with the "
+                      f"{cur_class_images} it contains.")
+            continue
+        class_images_dir.mkdir(parents=True, exist_ok=True)
+        cur_class_images = len(load_manifest(str(class_images_dir), manifest_dir))
+
+        if cur_class_images >= args.num_class_images:
+            continue
+        num_new_images = args.num_class_images - cur_class_images
+        library = library_dir(args, concept)
+        if library is not None:
+            linked = link_images(library, class_images_dir, num_new_images)
+            if linked:
+                print(f"Linked {linked} class images from the class image library {library}.")
+            num_new_images -= linked
+            if num_new_images <= 0:
+                continue
+            if args.total_steps:
+                library = None
+
+        shared.state.textinfo = f"Generating class images for training..."
+        if pipeline is None:
+            pipeline = load_pipeline(args, accelerator)
+
+        out_dir = library or class_images_dir
+        job, offsets = plan_generation(out_dir, concept["class_prompt"], num_new_images)
+        if accelerator.is_main_process:
+            # Leftovers of images that were being saved when a previous run was stopped.
+            for name in os.listdir(out_dir):
+                if name.endswith(".jpg.tmp"):
+                    os.remove(out_dir / name)
+            write_generation(out_dir, job)
+        accelerator.wait_for_everyone()
+        if len(offsets) < job["count"]:
+            print(f"Resuming class image generation, {job['count'] - len(offsets)} images were already generated.")
+        print(f"Number of class images to sample: {num_new_images}.")
+        save_txt = "[filewords]" in concept["class_prompt"]
+        filename_texts = [text_getter.entry_text(x) for x in load_manifest(concept["instance_data_dir"], manifest_dir)]
+        sample_dataset = PromptDataset(concept["class_prompt"], filename_texts, job["count"], offsets)
+        interrupted = sample_images(pipeline, args, accelerator, sample_dataset, out_dir, job["first_index"], save_txt)
+        accelerator.wait_for_everyone()
+        if interrupted:
+            print("Class image generation cancelled, it will resume from here on the next run.")
+            break
+        if accelerator.is_main_process:
+            os.remove(out_dir / GENERATION_FILE)
+        if library is not None:
+            link_images(library, class_images_dir, num_new_images)
+
+    if isinstance(pipeline, WebuiPipeline):
+        pipeline.close()
+    del pipeline
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return interrupted
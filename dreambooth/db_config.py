@@ -13,6 +13,21 @@ class DreamboothConfig(dict):
         self.src = None
         self.total_steps = None
         self.__dict__ = self
+        # Settings below are not exposed in the UI, but can be changed in db_config.json.
+        self.cache_latents_to_disk = True
+        self.cache_caption_variants = 4
+        self.latent_crop_scale = 1.0
+        self.latent_cache_dtype = "fp16"
+        self.cache_batch_size = 0
+        self.aspect_buckets = False
+        self.streaming_dataset = False
+        self.shuffle_buffer = 1000
+        self.cache_resized_images = True
+        self.dataloader_prefetch_factor = 2
+        self.dataloader_persistent_workers = True
+        self.prefetch_batches = 2
+        self.class_image_library = True
+        self.class_use_webui_model = True
 
     def create_new(self, name, scheduler, src, total_steps):
         name = images.sanitize_filename_part(name, True)
@@ -63,7 +78,12 @@ class DreamboothConfig(dict):
                 concepts_list,
                 use_cpu,
                 pad_tokens,
-                hflip):
+                hflip,
+                dataloader_workers,
+                class_scheduler,
+                class_infer_steps,
+                class_guidance_scale,
+                class_negative_prompt):
 
         pretrained_model_name_or_path = images.sanitize_filename_part(pretrained_model_name_or_path, True)
         pretrained_vae_name_or_path = images.sanitize_filename_part(pretrained_vae_name_or_path, True)
@@ -115,6 +135,11 @@ class DreamboothConfig(dict):
                 "use_cpu": use_cpu,
                 "pad_tokens": pad_tokens,
                 "hflip": hflip,
+                "dataloader_workers": dataloader_workers,
+                "class_scheduler": class_scheduler,
+                "class_infer_steps": class_infer_steps,
+                "class_guidance_scale": class_guidance_scale,
+                "class_negative_prompt": class_negative_prompt,
                 "prior_loss_weight": 1,
                 "seed": None}
         for key in data:
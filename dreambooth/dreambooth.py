@@ -67,7 +67,12 @@ def load_params(pretrained_model_name_or_path,
                 concepts_list,
                 use_cpu,
                 pad_tokens,
-                hflip):
+                hflip,
+                dataloader_workers,
+                class_scheduler,
+                class_infer_steps,
+                class_guidance_scale,
+                class_negative_prompt):
     tc = DreamboothConfig()
 
     tc.from_ui(pretrained_model_name_or_path,
@@ -110,7 +115,12 @@ def load_params(pretrained_model_name_or_path,
                concepts_list,
                use_cpu,
                pad_tokens,
-               hflip)
+               hflip,
+               dataloader_workers,
+               class_scheduler,
+               class_infer_steps,
+               class_guidance_scale,
+               class_negative_prompt)
 
     target_values = ["pretrained_vae_name_or_path",
                      "instance_data_dir",
@@ -151,7 +161,12 @@ def load_params(pretrained_model_name_or_path,
                      "concepts_list",
                      "use_cpu",
                      "pad_tokens",
-                     "hflip"]
+                     "hflip",
+                     "dataloader_workers",
+                     "class_scheduler",
+                     "class_infer_steps",
+                     "class_guidance_scale",
+                     "class_negative_prompt"]
 
     data = tc.from_file(pretrained_model_name_or_path)
     values = []
@@ -216,7 +231,12 @@ def start_training(pretrained_model_name_or_path,
                    concepts_list,
                    use_cpu,
                    pad_tokens,
-                   hflip
+                   hflip,
+                   dataloader_workers,
+                   class_scheduler,
+                   class_infer_steps,
+                   class_guidance_scale,
+                   class_negative_prompt
                    ):
     print("Starting Dreambooth training...")
     shared.sd_model.to('cpu')
@@ -273,7 +293,12 @@ def start_training(pretrained_model_name_or_path,
                    concepts_list,
                    use_cpu,
                    pad_tokens,
-                   hflip)
+                   hflip,
+                   dataloader_workers,
+                   class_scheduler,
+                   class_infer_steps,
+                   class_guidance_scale,
+                   class_negative_prompt)
     config.save()
     if not os.path.exists(config.working_dir):
         print("Invalid training data dir!")
@@ -0,0 +1,183 @@
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from tqdm.auto import tqdm
+
+from dreambooth.archives import file_stat, image_source
+
+
+def open_image(image_path, size: Optional[int] = None) -> Image.Image:
+    """
+    Open an image as RGB, decoding it no larger than needed when it will be resized so its shorter side is size.
+    JPEGs are decoded at a reduced DCT scale, other formats are box-reduced by an integer factor first, which is much
+    cheaper than resizing from full resolution. The shorter side is never reduced below size.
+    """
+    image = Image.open(image_source(image_path))
+    if size and image.format == "JPEG":
+        # draft() picks the smallest scale that keeps both sides at least this big.
+        image.draft("RGB", (size, size))
+    if not image.mode == "RGB":
+        image = image.convert("RGB")
+    if size:
+        factor = min(image.size) // size
+        if factor >= 2:
+            image = image.reduce(factor)
+    return image
+
+
+class ImageShardCache:
+    """
+    Resolution-matched uint8 copies of training images, packed into memory-mapped shard files.
+
+    Decoding and resizing full-size photos every step dominates CPU time when latents aren't cached, so images are
+    resized once and read back from the shards afterwards. Entries are keyed on the source path, size and mtime (ns),
+    and only new or changed images are written on later runs.
+    """
+
+    def __init__(self, cache_dir: str, size: int, max_shard_bytes: int = 1024 ** 3):
+        self.cache_dir = os.path.join(cache_dir, str(size))
+        self.max_shard_bytes = max_shard_bytes
+        self.index_file = os.path.join(self.cache_dir, "index.json")
+        self.entries = {}
+        self.shards = []
+        # Memory maps are opened lazily, so every dataloader worker maps the shards itself.
+        self._maps = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r") as f:
+                    index = json.load(f)
+                self.entries = index["entries"]
+                self.shards = index["shards"]
+            except Exception as e:
+                print(f"Exception loading image cache index, rebuilding: {e}")
+                self.entries = {}
+                self.shards = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    @staticmethod
+    def _key(image_path) -> str:
+        return os.path.abspath(image_path)
+
+    def _is_current(self, key: str, stat: Tuple[int, int]) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and [entry["size"], entry.get("mtime_ns")] == list(stat)
+
+    def _read(self, entry: Dict) -> np.ndarray:
+        shard = entry["shard"]
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(os.path.join(self.cache_dir, shard), dtype=np.uint8, mode="r")
+        height, width = entry["shape"]
+        offset = entry["offset"]
+        return self._maps[shard][offset:offset + height * width * 3].reshape(height, width, 3)
+
+    def build(self, image_paths: List, resize_fn: Callable[[str], Image.Image],
+              file_stats: Optional[Dict[str, Tuple[int, int]]] = None):
+        """
+        Write resized copies of every new or changed image to a new shard, and drop shards no longer in use.
+        Args:
+            image_paths: The source images to cache.
+            resize_fn: Loads an image path as a resized RGB PIL image.
+            file_stats: The (size, mtime in ns) of images by absolute path, as listed in their manifests. Images
+                missing from it are stat-ed.
+        """
+        file_stats = file_stats or {}
+        stale = []
+        live = {}
+        for image_path in dict.fromkeys(image_paths):
+            key = self._key(image_path)
+            stat = file_stats.get(key)
+            if stat is None:
+                stat = file_stat(image_path)
+                stat = (stat.st_size, stat.st_mtime_ns)
+            live[key] = stat
+            if not self._is_current(key, stat):
+                stale.append((image_path, key, stat))
+
+        # Shards that are mostly dead are rewritten, so the cache doesn't keep growing when images change.
+        stale_keys = {key for _, key, _ in stale}
+        shard_bytes = {shard: 0 for shard in self.shards}
+        for key in live:
+            if key in self.entries and key not in stale_keys:
+                entry = self.entries[key]
+                shard_bytes[entry["shard"]] = shard_bytes.get(entry["shard"], 0) + entry["nbytes"]
+        rewrite = set()
+        for shard in self.shards:
+            path = os.path.join(self.cache_dir, shard)
+            if os.path.exists(path) and shard_bytes.get(shard, 0) < os.path.getsize(path) // 2:
+                rewrite.add(shard)
+        moved = [key for key in live if key not in stale_keys and key in self.entries
+                 and self.entries[key]["shard"] in rewrite]
+
+        if len(stale) or len(moved):
+            writer = None
+            written = 0
+            for image_path, key, stat in tqdm(stale + [(None, key, live[key]) for key in moved],
+                                              desc="Caching resized images"):
+                if image_path is None:
+                    pixels = np.array(self._read(self.entries[key]))
+                else:
+                    try:
+                        pixels = np.asarray(resize_fn(image_path).convert("RGB"), dtype=np.uint8)
+                    except Exception as e:
+                        print(f"Unable to cache {image_path}: {e}")
+                        self.entries.pop(key, None)
+                        continue
+                if writer is None or written + pixels.nbytes > self.max_shard_bytes:
+                    if writer is not None:
+                        writer.close()
+                    shard = self._new_shard_name()
+                    self.shards.append(shard)
+                    writer = open(os.path.join(self.cache_dir, shard), "wb")
+                    written = 0
+                writer.write(pixels.tobytes())
+                self.entries[key] = {
+                    "size": stat[0],
+                    "mtime_ns": stat[1],
+                    "shard": self.shards[-1],
+                    "offset": written,
+                    "shape": [pixels.shape[0], pixels.shape[1]],
+                    "nbytes": pixels.nbytes,
+                }
+                written += pixels.nbytes
+            if writer is not None:
+                writer.close()
+
+        # Only keep entries for images that are still in use, then delete shards nothing points to anymore.
+        self.entries = {key: entry for key, entry in self.entries.items() if key in live}
+        used = {entry["shard"] for entry in self.entries.values()}
+        self._maps = {}
+        for shard in self.shards:
+            if shard not in used:
+                try:
+                    os.remove(os.path.join(self.cache_dir, shard))
+                except FileNotFoundError:
+                    pass
+        self.shards = [shard for shard in self.shards if shard in used]
+        self.save()
+
+    def _new_shard_name(self) -> str:
+        number = 0
+        existing = set(self.shards) | set(os.listdir(self.cache_dir))
+        while f"shard-{number:05d}.bin" in existing:
+            number += 1
+        return f"shard-{number:05d}.bin"
+
+    def get(self, image_path) -> Optional[Image.Image]:
+        entry = self.entries.get(self._key(image_path))
+        if entry is None:
+            return None
+        return Image.fromarray(self._read(entry), "RGB")
+
+    def save(self):
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"shards": self.shards, "entries": self.entries}, f)
+        os.replace(tmp_file, self.index_file)
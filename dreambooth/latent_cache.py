@@ -0,0 +1,377 @@
+import hashlib
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from dreambooth.archives import file_stat, read_bytes, split_member
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha1()
+    if split_member(path) is not None:
+        sha.update(read_bytes(path))
+        return sha.hexdigest()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class LatentCache:
+    """
+    Content-addressed on-disk cache of VAE latent distribution parameters.
+
+    Entries are keyed on the image file contents, the VAE weights and the image transform settings, so they can be
+    reused across training runs and only new or changed images need to go through the VAE. File hashes are
+    remembered by (size, mtime) in an index, so unchanged files are not re-read on every start. Entries and index rows
+    a run doesn't use are removed by prune().
+    """
+
+    def __init__(self, cache_dir: str, vae_dir: str, transform_key: str,
+                 file_stats: Optional[Dict[str, Tuple[int, int]]] = None):
+        self.cache_dir = cache_dir
+        # The (size, mtime in ns) of images by absolute path, as listed in their manifests. Other files are stat-ed.
+        self.file_stats = file_stats or {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.index = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        # The files hashed and the entries looked up by this run, everything else is dead to prune().
+        self.live_files = set()
+        self.live_entries = set()
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r") as f:
+                    self.index = json.load(f)
+            except Exception as e:
+                print(f"Exception loading latent cache index, rebuilding: {e}")
+                self.index = {}
+
+        vae_files = sorted(os.path.join(vae_dir, file) for file in os.listdir(vae_dir))
+        vae_hash = hashlib.sha1()
+        for file in vae_files:
+            if os.path.isfile(file):
+                vae_hash.update(self.file_hash(file).encode())
+        vae_hash.update(transform_key.encode())
+        self.prefix = vae_hash.hexdigest()[:16]
+
+    def file_hash(self, path) -> str:
+        path = os.path.abspath(path)
+        self.live_files.add(path)
+        stat = self.file_stats.get(path)
+        if stat is None:
+            stat = file_stat(path)
+            stat = (stat.st_size, stat.st_mtime_ns)
+        entry = self.index.get(path)
+        if entry is not None and [entry["size"], entry.get("mtime_ns")] == list(stat):
+            return entry["sha1"]
+        digest = hash_file(path)
+        self.index[path] = {"size": stat[0], "mtime_ns": stat[1], "sha1": digest}
+        self.dirty = True
+        return digest
+
+    def entry_path(self, image_path, variant: str = "") -> str:
+        key = self.file_hash(image_path)
+        if variant:
+            key = f"{key}-{variant}"
+        entry_path = os.path.join(self.cache_dir, self.prefix, key[:2], f"{key}.npy")
+        self.live_entries.add(os.path.normpath(entry_path))
+        return entry_path
+
+    def load(self, image_path, variant: str = "") -> Optional[torch.Tensor]:
+        entry_path = self.entry_path(image_path, variant)
+        if not os.path.exists(entry_path):
+            return None
+        try:
+            # Copy-on-write mapping, pages are only read when the tensor is used.
+            return torch.from_numpy(np.load(entry_path, mmap_mode="c"))
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable latent cache entry {entry_path}: {e}")
+            return None
+
+    def save(self, image_path, params: torch.Tensor, variant: str = ""):
+        entry_path = self.entry_path(image_path, variant)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Every process encodes the images it's missing, each writes its own temporary file.
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, params.detach().float().cpu().numpy())
+        os.replace(tmp_path, entry_path)
+
+    def get_or_encode(self, image_paths: List, load_fn: Callable, encode_fn: Callable,
+                      flip: bool = False, variant: str = "") -> torch.Tensor:
+        """
+        Return stacked latent distribution parameters for image_paths, encoding only images that are not cached.
+        Args:
+            image_paths: The source image of each sample.
+            load_fn: Loads a single image path into a normalized pixel tensor.
+            encode_fn: Encodes a stacked pixel batch into latent distribution parameters.
+            flip: Also return the latents of the horizontally flipped image.
+            variant: Tells apart entries of the same image encoded differently, e.g. cropped to another size.
+
+        Returns: A float32 tensor of shape (len(image_paths), 8, h, w) on the CPU, or (len(image_paths), 2, 8, h, w)
+        holding the unflipped and flipped latents of each image if flip is set.
+
+        """
+        variants = (variant, f"{variant}-flip" if variant else "flip") if flip else (variant,)
+        found = {}
+        for image_path in image_paths:
+            for entry_variant in variants:
+                if (image_path, entry_variant) not in found:
+                    found[(image_path, entry_variant)] = self.load(image_path, entry_variant)
+        missing = [key for key, params in found.items() if params is None]
+        self.hits += len(found) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            pixels = {}
+            for image_path, _ in missing:
+                if image_path not in pixels:
+                    pixels[image_path] = load_fn(image_path)
+            pixel_values = torch.stack([torch.flip(pixels[image_path], dims=[-1]) if entry_variant != variant
+                                        else pixels[image_path] for image_path, entry_variant in missing])
+            pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
+            encoded = encode_fn(pixel_values).float().cpu()
+            for (image_path, entry_variant), params in zip(missing, encoded):
+                self.save(image_path, params, entry_variant)
+                found[(image_path, entry_variant)] = params
+        if flip:
+            return torch.stack([torch.stack([found[(image_path, entry_variant)].float() for entry_variant in variants])
+                                for image_path in image_paths])
+        return torch.stack([found[(image_path, variant)].float() for image_path in image_paths])
+
+    def prune(self) -> int:
+        """
+        Remove the entries this run didn't look up, those of other VAEs or transform settings and of images that were
+        deleted, changed or encoded at other crop sizes, and the index rows of files it didn't hash. Call once every
+        image of the run went through get_or_encode.
+        Returns: The number of entries removed.
+        """
+        removed = 0
+        for root, dirs, files in os.walk(self.cache_dir, topdown=False):
+            for file in files:
+                path = os.path.normpath(os.path.join(root, file))
+                if ".npy" in file and path not in self.live_entries:
+                    os.remove(path)
+                    removed += 1
+            if root != self.cache_dir and not os.listdir(root):
+                os.rmdir(root)
+        dead_files = [path for path in self.index if path not in self.live_files]
+        for path in dead_files:
+            del self.index[path]
+        self.dirty = self.dirty or len(dead_files) > 0
+        return removed
+
+    def flush(self):
+        if not self.dirty:
+            return
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_file, self.index_file)
+        self.dirty = False
+
+
+LATENT_CACHE_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "int8": torch.int8}
+
+
+def quantize_int8(values: torch.Tensor):
+    """
+    Symmetric int8 quantization with one scale per sample and channel.
+    Returns: The int8 values, and float32 scales of shape (n, channels).
+    """
+    values = values.float()
+    scales = values.abs().amax(dim=tuple(range(2, values.dim()))).clamp(min=1e-8) / 127
+    quantized = torch.round(values / scales.view(*scales.shape, *[1] * (values.dim() - 2))).to(torch.int8)
+    return quantized, scales
+
+
+def dequantize_int8(quantized: torch.Tensor, scales: torch.Tensor, dtype=torch.float32) -> torch.Tensor:
+    return (quantized.float() * scales.view(*scales.shape, *[1] * (quantized.dim() - 2))).to(dtype)
+
+
+class LatentStore:
+    """
+    Preallocated per-sample buffer for cached latent distribution parameters (mean and logvar stacked on the channel
+    dim, as produced by the VAE) or text encoder states. Rows are filled in order with add() and gathered with get(),
+    so batches can be assembled from any set of samples. With dtype torch.int8, rows are quantized per sample and
+    channel, and get() dequantizes them to fp16.
+    """
+
+    def __init__(self, num_rows: int, dtype: Optional[torch.dtype] = None, device=None):
+        self.num_rows = num_rows
+        self.dtype = dtype
+        self.device = device
+        self.buffer = None
+        self.scales = None
+        self.count = 0
+
+    def add(self, values: torch.Tensor) -> range:
+        if self.buffer is None:
+            dtype = self.dtype or values.dtype
+            self.buffer = torch.empty((self.num_rows, *values.shape[1:]), dtype=dtype, device=self.device)
+            if dtype == torch.int8:
+                self.scales = torch.empty((self.num_rows, values.shape[1]), dtype=torch.float32, device=self.device)
+        rows = range(self.count, self.count + values.shape[0])
+        if self.scales is not None:
+            values, scales = quantize_int8(values)
+            self.scales[rows.start:rows.stop] = scales.to(self.scales.device)
+        self.buffer[rows.start:rows.stop] = values.to(self.buffer.device, dtype=self.buffer.dtype)
+        self.count = rows.stop
+        return rows
+
+    def get(self, rows: torch.Tensor) -> torch.Tensor:
+        rows = rows.to(self.buffer.device)
+        if self.scales is not None:
+            return dequantize_int8(self.buffer[rows], self.scales[rows], torch.float16)
+        return self.buffer[rows]
+
+    def nbytes(self) -> int:
+        if self.buffer is None:
+            return 0
+        nbytes = self.buffer.element_size() * self.buffer.nelement()
+        if self.scales is not None:
+            nbytes += self.scales.element_size() * self.scales.nelement()
+        return nbytes
+
+
+class QuantizationReport:
+    """
+    Accumulates the size and reconstruction error every latent cache dtype would have on the values being cached,
+    so the storage mode can be chosen per dataset.
+    """
+
+    def __init__(self):
+        self.nbytes = {name: 0 for name in LATENT_CACHE_DTYPES}
+        self.squared_error = {name: 0.0 for name in LATENT_CACHE_DTYPES}
+        self.squared_total = 0.0
+
+    def update(self, values: torch.Tensor):
+        values = values.detach().float().cpu()
+        self.squared_total += float(values.pow(2).sum())
+        for name, dtype in LATENT_CACHE_DTYPES.items():
+            if dtype == torch.int8:
+                quantized, scales = quantize_int8(values)
+                restored = dequantize_int8(quantized, scales)
+                self.nbytes[name] += quantized.nelement() + scales.nelement() * scales.element_size()
+            else:
+                restored = values.to(dtype).float()
+                self.nbytes[name] += values.nelement() * torch.finfo(dtype).bits // 8
+            self.squared_error[name] += float((restored - values).pow(2).sum())
+
+    def summary(self) -> str:
+        lines = []
+        for name in LATENT_CACHE_DTYPES:
+            error = (self.squared_error[name] / max(self.squared_total, 1e-12)) ** 0.5
+            lines.append(f"{name}: {self.nbytes[name] / 1024 ** 2:.1f}MB, relative RMS error {error:.2e}")
+        return "\n".join(lines)
+
+
+def is_oom_error(e: Exception) -> bool:
+    # torch.cuda.OutOfMemoryError only exists in newer torch versions, it subclasses RuntimeError.
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+def estimate_encode_batch_size(resolution: int, device, dtype=torch.float32, max_batch_size: int = 32) -> int:
+    """
+    Guess how many images the VAE can encode at once from the free device memory. The encoder's peak is a handful of
+    128 channel activations at full resolution per image. BatchedEncoder halves the batch if the guess is too high.
+    """
+    device = torch.device(device)
+    if device.type != "cuda":
+        return 4
+    free, _ = torch.cuda.mem_get_info(device)
+    per_image = 12 * 128 * resolution * resolution * torch.finfo(dtype).bits // 8
+    return int(max(1, min(max_batch_size, free * 0.8 // per_image)))
+
+
+def tile_starts(size: int, tile_size: int, stride: int) -> List[int]:
+    if size <= tile_size:
+        return [0]
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def encode_tiled(encode_fn: Callable, pixel_values: torch.Tensor, tile_size: int) -> torch.Tensor:
+    """
+    Encode images in overlapping tiles of tile_size pixels, so only one tile's activations have to fit in memory.
+    Where tiles overlap, their latent parameters are blended with linear ramps across the overlap, so tile borders
+    don't show as seams. Sizes are multiples of 8, tile_size of 64.
+    """
+    overlap = tile_size // 8
+    height, width = pixel_values.shape[-2:]
+    params = None
+    weights = None
+    for top in tile_starts(height, tile_size, tile_size - overlap):
+        for left in tile_starts(width, tile_size, tile_size - overlap):
+            tile = encode_fn(pixel_values[..., top:top + tile_size, left:left + tile_size]).cpu()
+            if params is None:
+                dtype = tile.dtype
+                params = torch.zeros(*tile.shape[:-2], height // 8, width // 8)
+                weights = torch.zeros(height // 8, width // 8)
+            tile_height, tile_width = tile.shape[-2:]
+            # Weights ramp up from the sides shared with a neighbouring tile, over the overlap.
+            ramp = torch.arange(1, overlap // 8 + 1) / (overlap // 8 + 1)
+            mask_y = torch.ones(tile_height)
+            mask_x = torch.ones(tile_width)
+            if top > 0:
+                mask_y[:len(ramp)] = torch.minimum(mask_y[:len(ramp)], ramp)
+            if top + tile_size < height:
+                mask_y[-len(ramp):] = torch.minimum(mask_y[-len(ramp):], ramp.flip(0))
+            if left > 0:
+                mask_x[:len(ramp)] = torch.minimum(mask_x[:len(ramp)], ramp)
+            if left + tile_size < width:
+                mask_x[-len(ramp):] = torch.minimum(mask_x[-len(ramp):], ramp.flip(0))
+            mask = mask_y[:, None] * mask_x[None, :]
+            rows = slice(top // 8, top // 8 + tile_height)
+            columns = slice(left // 8, left // 8 + tile_width)
+            params[..., rows, columns] += tile.float() * mask
+            weights[rows, columns] += mask
+    return (params / weights).to(dtype)
+
+
+class BatchedEncoder:
+    """
+    Runs encode_fn over a pixel batch in chunks of batch_size. On out of memory errors the chunk size is halved, and
+    once single images don't fit, they're encoded in overlapping tiles (see encode_tiled) that are halved in turn.
+    """
+
+    def __init__(self, encode_fn: Callable, batch_size: int, min_tile_size: int = 128):
+        self.encode_fn = encode_fn
+        self.batch_size = max(1, batch_size)
+        self.min_tile_size = min_tile_size
+        self.tile_size = None
+
+    def encode(self, chunk: torch.Tensor) -> torch.Tensor:
+        if self.tile_size is None or max(chunk.shape[-2:]) <= self.tile_size:
+            return self.encode_fn(chunk).cpu()
+        return encode_tiled(self.encode_fn, chunk, self.tile_size)
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        encoded = []
+        start = 0
+        while start < len(pixel_values):
+            chunk = pixel_values[start:start + self.batch_size]
+            try:
+                # Moved off the device right away, so the rest of the batch has the memory.
+                encoded.append(self.encode(chunk))
+                start += len(chunk)
+            except RuntimeError as e:
+                if not is_oom_error(e):
+                    raise
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                if self.batch_size > 1:
+                    self.batch_size //= 2
+                    print(f"Out of memory encoding latents, encoding {self.batch_size} images at a time.")
+                    continue
+                # Tiles are multiples of 64 pixels, half the current tile (or image) size.
+                tile_size = (self.tile_size or max(chunk.shape[-2:])) // 2 // 64 * 64
+                if tile_size < self.min_tile_size:
+                    raise
+                self.tile_size = tile_size
+                print(f"Out of memory encoding latents, encoding images in {tile_size}px tiles.")
+        return torch.cat(encoded)
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from dreambooth.archives import get_reader, image_source, is_archive, read_bytes
+
+MANIFEST_VERSION = 2
+
+
+def manifest_file(manifest_dir: str, data_dir: str) -> str:
+    key = hashlib.sha1(os.path.abspath(data_dir).encode()).hexdigest()[:16]
+    return os.path.join(manifest_dir, f"{key}.jsonl")
+
+
+def read_image_size(image_path):
+    try:
+        with Image.open(image_source(image_path)) as image:
+            return image.size
+    except Exception as e:
+        print(f"Unable to read image size of {image_path}: {e}")
+        return 0, 0
+
+
+def read_caption(txt_path) -> Optional[str]:
+    try:
+        return read_bytes(txt_path).decode("utf8")
+    except (FileNotFoundError, KeyError):
+        return None
+
+
+def list_files(data_dir: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Returns: The name -> (size, mtime in ns) of every file in data_dir, or of every member if data_dir is an archive.
+    """
+    if is_archive(data_dir):
+        return {name: (size, int(mtime * 1e9)) for name, (_, size, mtime) in get_reader(data_dir).index().items()}
+    files = {}
+    with os.scandir(data_dir) as it:
+        for item in it:
+            if item.is_file():
+                stat = item.stat()
+                files[item.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def scan_directory(data_dir: str, previous: Dict[str, Dict]) -> List[Dict]:
+    """
+    List the images in data_dir, reusing previous entries whose image and caption file haven't changed.
+    """
+    extensions = Image.registered_extensions()
+    files = list_files(data_dir)
+    images = []
+    texts = {}
+    for name, (size, mtime) in files.items():
+        stem, ext = os.path.splitext(name)
+        if ext == ".txt":
+            # The size too, a caption rewritten within the filesystem's mtime granularity usually changes length.
+            texts[stem] = [size, mtime]
+        elif ext in extensions:
+            images.append(name)
+
+    entries = []
+    for name in sorted(images):
+        size, mtime = files[name]
+        stem = os.path.splitext(name)[0]
+        txt_stat = texts.get(stem)
+        entry = previous.get(name)
+        if entry is None or entry["size"] != size or entry["mtime"] != mtime:
+            width, height = read_image_size(os.path.join(data_dir, name))
+            entry = {"name": name, "size": size, "mtime": mtime, "width": width, "height": height,
+                     "caption": None, "txt_stat": None}
+        if entry["txt_stat"] != txt_stat:
+            entry = dict(entry, txt_stat=txt_stat, caption=None)
+            if txt_stat is not None:
+                entry["caption"] = read_caption(os.path.join(data_dir, f"{stem}.txt"))
+        entries.append(entry)
+    return entries
+
+
+def read_header(file: str) -> Optional[Dict]:
+    try:
+        with open(file, "r", encoding="utf8") as f:
+            header = json.loads(f.readline())
+        return header if header.get("version") == MANIFEST_VERSION else None
+    except (OSError, ValueError):
+        return None
+
+
+def update_manifest(data_dir: str, manifest_dir: str) -> str:
+    """
+    Make sure the manifest of data_dir is current. The directory is listed on every call, and only images and captions
+    whose size or mtime changed since the manifest was written are read again. The manifest is only rewritten if
+    anything changed.
+    Returns: The manifest file.
+    """
+    file = manifest_file(manifest_dir, data_dir)
+    header = read_header(file) if os.path.exists(file) else None
+    previous = {}
+    if header is not None:
+        try:
+            previous = {entry["name"]: entry for entry in iter_manifest(file)}
+        except Exception as e:
+            print(f"Exception loading dataset manifest {file}, rescanning: {e}")
+            previous = {}
+
+    entries = scan_directory(data_dir, previous)
+    if header is not None and entries == list(previous.values()):
+        return file
+    try:
+        os.makedirs(manifest_dir, exist_ok=True)
+        tmp_file = f"{file}.tmp"
+        with open(tmp_file, "w", encoding="utf8") as f:
+            f.write(json.dumps({"version": MANIFEST_VERSION, "data_dir": os.path.abspath(data_dir),
+                                "count": len(entries)}) + "\n")
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_file, file)
+    except OSError as e:
+        print(f"Unable to save dataset manifest {file}: {e}")
+    return file
+
+
+def iter_manifest(file: str, data_dir: Optional[str] = None, shard: int = 0, num_shards: int = 1,
+                  limit: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Read the entries of a manifest file one line at a time, without holding the listing in memory.
+    Args:
+        file: The manifest file.
+        data_dir: If set, a "path" is added to every entry.
+        shard: Only yield every num_shards-th entry, starting at this one.
+        num_shards: The number of shards the entries are split into.
+        limit: Only read the first limit entries.
+    """
+    with open(file, "r", encoding="utf8") as f:
+        f.readline()
+        for index, line in enumerate(f):
+            if limit is not None and index >= limit:
+                break
+            if index % num_shards != shard:
+                continue
+            entry = json.loads(line)
+            if data_dir is not None:
+                entry["path"] = os.path.join(data_dir, entry["name"])
+            yield entry
+
+
+def load_manifest(data_dir: str, manifest_dir: Optional[str] = None) -> List[Dict]:
+    """
+    Load the image listing of data_dir from its manifest, updating it if the directory changed since it was written.
+
+    Each entry holds the image path, file size, mtime (ns), width, height, and the contents of the image's .txt
+    caption file (None if it has none). The directory is listed every time, but only new or changed images and
+    captions are opened, so a run on a large or remote directory doesn't read every file.
+    Args:
+        data_dir: The directory of images.
+        manifest_dir: Where manifests are stored, or None to scan without persisting anything.
+
+    Returns: A list of entry dicts sorted by file name.
+
+    """
+    if manifest_dir is None:
+        return [dict(entry, path=os.path.join(data_dir, entry["name"])) for entry in scan_directory(data_dir, {})]
+    file = update_manifest(data_dir, manifest_dir)
+    if not os.path.exists(file):
+        # The manifest couldn't be written, scan in memory.
+        return load_manifest(data_dir)
+    return list(iter_manifest(file, data_dir))
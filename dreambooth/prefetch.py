@@ -0,0 +1,94 @@
+import queue
+import threading
+from contextlib import nullcontext
+
+import torch
+
+
+def to_device(batch, device, non_blocking=False):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {key: to_device(value, device, non_blocking) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(value, device, non_blocking) for value in batch)
+    return batch
+
+
+def record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            record_stream(value, stream)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            record_stream(value, stream)
+
+
+class BatchPrefetcher:
+    """
+    Iterates a dataloader on a background thread and moves up to num_batches batches to the device ahead of use.
+
+    On CUDA the copies run on a side stream, and the training stream waits on an event recorded after each batch's
+    copy, so transfers overlap with the previous steps. On CPU the batches are just loaded ahead. Batches should be in
+    pinned memory (DataLoader(pin_memory=True)) for the copies to be asynchronous.
+    """
+
+    def __init__(self, loader, device, num_batches: int = 2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_batches = max(1, num_batches)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _load(self, batches: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+            with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                for batch in self.loader:
+                    batch = to_device(batch, self.device, non_blocking=True)
+                    event = None
+                    if stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    if not put((batch, event, None)):
+                        return
+        except Exception as e:
+            put((None, None, e))
+            return
+        put(None)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._load, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                batch, event, exception = item
+                if exception is not None:
+                    raise exception
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    # The batch was allocated on the side stream, keep its memory until this stream is done with it.
+                    record_stream(batch, stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
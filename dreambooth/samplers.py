@@ -0,0 +1,221 @@
+import math
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch.utils.data import Sampler
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Random batches of dataset indices whose prompts have similar token lengths.
+
+    Without pad_tokens, every prompt in a batch is padded to the longest one, so a random batch mixing short and long
+    captions wastes text encoder (and cross-attention) work on padding. Indices are shuffled, split into groups of
+    group_batches batches, sorted by length within each group and cut into batches, and the batches are shuffled
+    again. Batches stay random across the dataset while their members have close lengths.
+    """
+
+    def __init__(self, lengths: List[int], batch_size: int, group_batches: int = 50, drop_last: bool = False):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.group_batches = group_batches
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).tolist()
+        group_size = self.batch_size * self.group_batches
+        batches = []
+        for start in range(0, len(indices), group_size):
+            group = sorted(indices[start:start + group_size], key=lambda index: self.lengths[index], reverse=True)
+            batches.extend(group[i:i + self.batch_size] for i in range(0, len(group), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        for index in torch.randperm(len(batches)).tolist():
+            yield batches[index]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Random batches of dataset indices that all belong to the same aspect ratio bucket, so their images have the same
+    size and can be stacked. Indices are shuffled within each bucket and cut into batches, then all batches are
+    shuffled together.
+    """
+
+    def __init__(self, buckets: List[int], batch_size: int, drop_last: bool = False):
+        self.buckets = buckets
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.bucket_indices = {}
+        for index, bucket in enumerate(buckets):
+            self.bucket_indices.setdefault(bucket, []).append(index)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.bucket_indices.values())
+        return sum((len(indices) + self.batch_size - 1) // self.batch_size for indices in self.bucket_indices.values())
+
+    def __iter__(self):
+        batches = []
+        for indices in self.bucket_indices.values():
+            indices = [indices[i] for i in torch.randperm(len(indices)).tolist()]
+            batches.extend(indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        for index in torch.randperm(len(batches)).tolist():
+            yield batches[index]
+
+
+class ConceptBatchSampler(Sampler):
+    """
+    Batches of a single concept, interleaved by concept weight rather than by how many images each concept has.
+
+    Concepts are drawn by smooth weighted round robin, so every stretch of steps is shared between them in proportion
+    to their weights. A concept that runs out of batches within an epoch is reshuffled and keeps going, and one that
+    reaches its step budget (counted over the whole run) stops being drawn. The epoch has as many batches as the
+    samples make, or fewer once every concept is over budget. Batches are also split by aspect ratio bucket if buckets
+    are given.
+    """
+
+    def __init__(self, concepts: List[int], batch_size: int, weights: List[float],
+                 budgets: Optional[List[Optional[int]]] = None, buckets: Optional[List[int]] = None,
+                 drop_last: bool = False):
+        self.batch_size = batch_size
+        self.weights = weights
+        self.budgets = budgets or [None] * len(weights)
+        self.drop_last = drop_last
+        self.groups: Dict[int, Dict[int, List[int]]] = {}
+        for index, concept in enumerate(concepts):
+            bucket = buckets[index] if buckets is not None else 0
+            self.groups.setdefault(concept, {}).setdefault(bucket, []).append(index)
+        # Batches drawn per concept so far, across epochs.
+        self.steps = [0] * len(weights)
+
+    def __len__(self):
+        sizes = [len(indices) for groups in self.groups.values() for indices in groups.values()]
+        if self.drop_last:
+            return sum(size // self.batch_size for size in sizes)
+        return sum((size + self.batch_size - 1) // self.batch_size for size in sizes)
+
+    def concept_batches(self, concept):
+        # An endless stream of the concept's batches, reshuffled on every pass.
+        while True:
+            batches = []
+            for indices in self.groups[concept].values():
+                indices = [indices[i] for i in torch.randperm(len(indices)).tolist()]
+                batches.extend(indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size))
+            if self.drop_last:
+                batches = [batch for batch in batches if len(batch) == self.batch_size]
+            if not batches:
+                return
+            for index in torch.randperm(len(batches)).tolist():
+                yield batches[index]
+
+    def __iter__(self):
+        streams = {concept: self.concept_batches(concept) for concept in self.groups}
+        credits = {concept: 0.0 for concept in streams}
+        for _ in range(len(self)):
+            active = [concept for concept in streams if self.weights[concept] > 0 and
+                      (self.budgets[concept] is None or self.steps[concept] < self.budgets[concept])]
+            if not active:
+                return
+            # Every active concept gains its weight, the one with the most credit is drawn and pays the total back.
+            total = sum(self.weights[concept] for concept in active)
+            for concept in active:
+                credits[concept] += self.weights[concept]
+            concept = max(active, key=credits.get)
+            credits[concept] -= total
+            batch = next(streams[concept], None)
+            if batch is None:
+                del streams[concept]
+                continue
+            self.steps[concept] += 1
+            yield batch
+
+
+def concept_weights(concepts_list: List[Dict], sample_counts: List[float]) -> List[float]:
+    """
+    The share of steps of every concept: its "sample_weight" (1 if unset) when any concept sets one, otherwise its
+    number of samples, which is how often it comes up in a plain shuffle.
+    """
+    if any("sample_weight" in concept for concept in concepts_list):
+        return [float(concept.get("sample_weight", 1)) for concept in concepts_list]
+    return [float(count) for count in sample_counts]
+
+
+def concept_draws(weights: List[float], budgets: List[Optional[int]], total_batches: int) -> List[float]:
+    """
+    About how many of total_batches ConceptBatchSampler gives each concept: shares in proportion to the weights, with
+    concepts that reach their step budget capped there and the rest of their share going to the others.
+    """
+    draws = [0.0] * len(weights)
+    active = [concept for concept, weight in enumerate(weights) if weight > 0]
+    remaining = float(total_batches)
+    while active and remaining > 0:
+        total = sum(weights[concept] for concept in active)
+        capped = [concept for concept in active
+                  if budgets[concept] is not None and remaining * weights[concept] / total >= int(budgets[concept])]
+        if not capped:
+            for concept in active:
+                draws[concept] = remaining * weights[concept] / total
+            break
+        for concept in capped:
+            draws[concept] = float(int(budgets[concept]))
+            remaining -= draws[concept]
+            active.remove(concept)
+    return draws
+
+
+def make_buckets(size: int, max_ratio: float = 2.0, step: int = 64,
+                 max_area_error: float = 0.125) -> List[Tuple[int, int]]:
+    """
+    (width, height) buckets with about the same number of pixels as a size x size square (up to max_area_error more
+    or less), sides multiples of step and aspect ratios up to max_ratio. Each width gets the height closest to the
+    square's pixel count that keeps it within max_ratio, so the widest buckets reach max_ratio.
+    """
+    area = size * size
+    buckets = {(size, size)}
+    width = size + step
+    while True:
+        tallest = int(area * (1 + max_area_error) / width) // step * step
+        if tallest < step or width / tallest > max_ratio:
+            break
+        heights = [height for height in range(step, tallest + 1, step)
+                   if width / height <= max_ratio and width * height >= area / (1 + max_area_error)]
+        if heights:
+            height = min(heights, key=lambda height: abs(width * height - area))
+            buckets.add((width, height))
+            buckets.add((height, width))
+        width += step
+    return sorted(buckets)
+
+
+def closest_bucket(buckets: List[Tuple[int, int]], width: int, height: int) -> int:
+    # Images of unknown size go to the square bucket.
+    if not width or not height:
+        width = height = 1
+    ratio = math.log(width / height)
+    return min(range(len(buckets)), key=lambda index: abs(math.log(buckets[index][0] / buckets[index][1]) - ratio))
+
+
+def concept_samples(instance_concepts: List[int], repeats: List[float]) -> List[int]:
+    """
+    The instance image index of every sample in an epoch. Each concept contributes its image count times its repeats
+    samples (at least one), cycling through its images, so the epoch length follows the instance images rather than
+    the number of class images.
+    Args:
+        instance_concepts: The concept index of every instance image.
+        repeats: How many times each concept's images are seen per epoch, fractions take part of them.
+    """
+    concept_images = {}
+    for index, concept in enumerate(instance_concepts):
+        concept_images.setdefault(concept, []).append(index)
+    samples = []
+    for concept, images in sorted(concept_images.items()):
+        count = max(1, round(len(images) * repeats[concept]))
+        samples.extend(images[i % len(images)] for i in range(count))
+    return samples
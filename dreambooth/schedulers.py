@@ -0,0 +1,36 @@
+import diffusers
+
+# Schedulers selectable for class image generation, by diffusers class name. Classes missing from the installed
+# diffusers version fall back to the model's own scheduler.
+SCHEDULERS = {
+    "ddim": "DDIMScheduler",
+    "pndm": "PNDMScheduler",
+    "lms": "LMSDiscreteScheduler",
+    "euler": "EulerDiscreteScheduler",
+    "euler_a": "EulerAncestralDiscreteScheduler",
+    "dpm++": "DPMSolverMultistepScheduler",
+}
+
+# The webui samplers closest to each of the schedulers above, for generating class images with the webui's model.
+WEBUI_SAMPLERS = {
+    "ddim": "DDIM",
+    "pndm": "PLMS",
+    "lms": "LMS",
+    "euler": "Euler",
+    "euler_a": "Euler a",
+    "dpm++": "DPM++ 2M",
+}
+
+
+def make_scheduler(name, config):
+    """
+    Create the named scheduler from a pipeline's scheduler config.
+    Returns: The scheduler, or None to keep the pipeline's own ("default", unknown or unavailable names).
+    """
+    if not name or name == "default":
+        return None
+    scheduler_class = getattr(diffusers, SCHEDULERS.get(name, ""), None)
+    if scheduler_class is None:
+        print(f"Scheduler {name} isn't available in this diffusers version, using the model's scheduler.")
+        return None
+    return scheduler_class.from_config(config)
@@ -1,7 +1,6 @@
 # From shivam shiaro's repo, with "minimal" modification to hopefully allow for smoother updating?
 import argparse
 import gc
-import hashlib
 import itertools
 import json
 import math
@@ -9,29 +8,39 @@ import os
 import random
 import re
 import sys
+import time
 import traceback
 from contextlib import nullcontext
 from pathlib import Path
-from typing import Optional
+from collections import OrderedDict
+from typing import List, Optional
 
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
-from PIL import Image, features
+from PIL import Image
 from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import set_seed
 from diffusers import AutoencoderKL, DDIMScheduler, DDPMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+from diffusers.models.vae import DiagonalGaussianDistribution
 from diffusers.optimization import get_scheduler
 from huggingface_hub import HfFolder, whoami
-from six import StringIO
 from torch import autocast
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from torchvision import transforms
 from tqdm.auto import tqdm
-from transformers import CLIPTextModel, CLIPTokenizer
+from transformers import CLIPTextModel, CLIPTokenizer, CLIPTokenizerFast
 
 from dreambooth import conversion
+from dreambooth.class_images import generate_class_images
+from dreambooth.image_cache import ImageShardCache, open_image
+from dreambooth.latent_cache import LATENT_CACHE_DTYPES, BatchedEncoder, LatentCache, LatentStore, QuantizationReport, \
+    estimate_encode_batch_size
+from dreambooth.manifest import iter_manifest, load_manifest, read_header, update_manifest
+from dreambooth.prefetch import BatchPrefetcher
+from dreambooth.samplers import BucketBatchSampler, ConceptBatchSampler, LengthGroupedBatchSampler, closest_bucket, \
+    concept_draws, concept_samples, concept_weights, make_buckets
 from modules import shared, sd_models, paths
 from modules.images import sanitize_filename_part
 
@@ -156,6 +165,43 @@ def parse_args(input_args=None):
         default=50,
         help="The number of inference steps for save sample.",
     )
+    parser.add_argument(
+        "--class_scheduler",
+        type=str,
+        default="dpm++",
+        choices=["default", "ddim", "pndm", "lms", "euler", "euler_a", "dpm++"],
+        help="The scheduler to generate class images with, default keeps the model's own.",
+    )
+    parser.add_argument(
+        "--class_infer_steps",
+        type=int,
+        default=20,
+        help="The number of inference steps for class images.",
+    )
+    parser.add_argument(
+        "--class_guidance_scale",
+        type=float,
+        default=7.5,
+        help="CFG for class images.",
+    )
+    parser.add_argument(
+        "--class_negative_prompt",
+        type=str,
+        default=None,
+        help="The negative prompt to generate class images with.",
+    )
+    parser.add_argument(
+        "--class_image_library",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="Share generated class images between models trained from the same source checkpoint.",
+    )
+    parser.add_argument(
+        "--class_use_webui_model",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="Generate class images with the webui's loaded model when it is the source checkpoint.",
+    )
     parser.add_argument(
         "--pad_tokens",
         default=False,
@@ -286,7 +332,85 @@ def parse_args(input_args=None):
         ),
     )
     parser.add_argument("--not_cache_latents", action="store_true", help="Do not precompute and cache latents from VAE.")
+    parser.add_argument(
+        "--cache_latents_to_disk",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="Persist cached latents under output_dir/latent_cache so later runs only encode new or changed images.",
+    )
     parser.add_argument("--hflip", action="store_true", help="Apply horizontal flip data augmentation.")
+    parser.add_argument(
+        "--cache_caption_variants",
+        type=int,
+        default=4,
+        help="Number of shuffled/dropped-out [filewords] captions to cache per image when caching latents.",
+    )
+    parser.add_argument(
+        "--aspect_buckets",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="Train non-square images at the bucket resolution closest to their aspect ratio instead of square crops.",
+    )
+    parser.add_argument(
+        "--streaming_dataset",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="When latents are not cached, stream images from the directory manifests instead of listing them all in"
+             " memory.",
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        type=int,
+        default=1000,
+        help="How many images the streaming dataset shuffles at a time.",
+    )
+    parser.add_argument(
+        "--cache_batch_size",
+        type=int,
+        default=0,
+        help="How many images the VAE encodes at once when caching latents. 0 picks it from free memory.",
+    )
+    parser.add_argument(
+        "--latent_cache_dtype",
+        type=str,
+        default="fp16",
+        choices=["fp32", "fp16", "int8"],
+        help="Storage type of cached latents. int8 is quantized per sample and channel.",
+    )
+    parser.add_argument(
+        "--latent_crop_scale",
+        type=float,
+        default=1.0,
+        help="When caching latents without center crop, cache images this much larger than the resolution and take"
+             " random crops of the latents at train time.",
+    )
+    parser.add_argument(
+        "--cache_resized_images",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="When latents are not cached, read images from pre-resized shards under output_dir/image_cache.",
+    )
+    parser.add_argument(
+        "--dataloader_workers",
+        type=int,
+        default=0,
+        help="Number of worker processes loading images when latents are not cached. 0 loads on the training thread.",
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        type=int,
+        default=2,
+        help="How many batches a background thread moves to the device ahead of the training step, 0 to disable.",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor", type=int, default=2, help="Number of batches each dataloader worker loads ahead."
+    )
+    parser.add_argument(
+        "--dataloader_persistent_workers",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="Keep dataloader workers alive between epochs.",
+    )
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
     parser.add_argument(
         "--concepts_list",
@@ -311,44 +435,73 @@ def parse_args(input_args=None):
     return args
 
 
-pil_features = []
+def get_filename(path):
+    return path.stem
 
 
-def list_features():
-    # Create buffer for pilinfo() to write into rather than stdout
-    buffer = StringIO()
-    features.pilinfo(out=buffer)
-    global pil_features
-    pil_features = []
-    # Parse and analyse lines
-    for line in buffer.getvalue().splitlines():
-        if "Extensions:" in line:
-            ext_list = line.split(": ")[1]
-            extensions = ext_list.split(", ")
-            for extension in extensions:
-                if not extension in pil_features:
-                    pil_features.append(extension)
+# Strings the fast tokenizer has to tokenize exactly like the slow one before it's used.
+TOKENIZER_PROBES = [
+    "a photo of zkz dog",
+    "[filewords], in the style of zymkyr",
+    "1girl, (masterpiece:1.2), Café  au lait,\tNAÏVE art... 8k uhd!!",
+    ", ".join(["a very long caption"] * 40),
+]
 
-def get_filename(path):
-    return path.stem
 
-def get_label_from_txt(path):
-    txt_path = path.with_suffix(".txt") # get the path to the .txt file
-    if txt_path.exists():
-        with open(txt_path, "r") as f:
-            return f.read()
-    else:
-        return ""
+def load_tokenizer(tokenizer_dir):
+    """
+    Load the fast CLIP tokenizer if it tokenizes the probe strings exactly like the slow one, otherwise the slow one.
+    """
+    tokenizer = CLIPTokenizer.from_pretrained(tokenizer_dir)
+    try:
+        fast_tokenizer = CLIPTokenizerFast.from_pretrained(tokenizer_dir)
+    except Exception as e:
+        print(f"Unable to load fast tokenizer, using the slow one: {e}")
+        return tokenizer
+    for probe in TOKENIZER_PROBES:
+        kwargs = {"truncation": True, "max_length": tokenizer.model_max_length}
+        if fast_tokenizer(probe, **kwargs).input_ids != tokenizer(probe, **kwargs).input_ids:
+            print("Fast tokenizer output doesn't match the slow tokenizer, using the slow one.")
+            return tokenizer
+    return fast_tokenizer
+
+
+class TokenCache:
+    """
+    Token ids memoized per prompt. Captions repeat every epoch, so only prompts that haven't been seen are tokenized,
+    in one call per batch. Shuffled and dropped-out tags produce a lot of distinct prompts, hence the LRU bound.
+    """
 
-def is_image(path: Path):
-    global pil_features
-    if not len(pil_features):
-        list_features()
-    is_img = path.is_file() and path.suffix in pil_features
-    # stop being noisy when reading a direcory of (.png, .txt) pairs created by preprocessing
-    # if not is_img:
-    #     print(f"Ignoring non-image file: {path}")
-    return is_img
+    def __init__(self, tokenizer, pad_tokens=False, max_size=16384):
+        self.tokenizer = tokenizer
+        self.pad_tokens = pad_tokens
+        self.max_size = max_size
+        self.ids = OrderedDict()
+
+    def __call__(self, prompts: List[str]) -> List[List[int]]:
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in self.ids]
+        if len(missing):
+            input_ids = self.tokenizer(
+                missing,
+                padding="max_length" if self.pad_tokens else "do_not_pad",
+                truncation=True,
+                max_length=self.tokenizer.model_max_length,
+            ).input_ids
+            self.ids.update(zip(missing, map(tuple, input_ids)))
+        for prompt in prompts:
+            self.ids.move_to_end(prompt)
+        result = [list(self.ids[prompt]) for prompt in prompts]
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+        return result
+
+    def pad(self, input_ids: List[List[int]], max_length=None) -> torch.Tensor:
+        # Same as tokenizer.pad for CLIP (padding on the right), without its per-call overhead.
+        max_length = max_length or max(len(ids) for ids in input_ids)
+        padded = torch.full((len(input_ids), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        for row, ids in enumerate(input_ids):
+            padded[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        return padded
 
 
 class FilenameTextGetter:
@@ -357,29 +510,31 @@ class FilenameTextGetter:
     re_numbers_at_start = re.compile(r"^[-\d]+\s*")
     
     def __init__(self):
+        # Options are copied here, so dataloader workers don't need to reach shared.opts.
         self.re_word = re.compile(shared.opts.dataset_filename_word_regex) if len(shared.opts.dataset_filename_word_regex) > 0 else None
-
-    def read_text(self, img_path):
-        text_filename = os.path.splitext(img_path)[0] + ".txt"
-        filename = os.path.basename(img_path)
-
-        if os.path.exists(text_filename):
-            with open(text_filename, "r", encoding="utf8") as file:
-                filename_text = file.read()
-        else:
-            filename_text = os.path.splitext(filename)[0]
-            filename_text = re.sub(self.re_numbers_at_start, '', filename_text)
-            if self.re_word:
-                tokens = self.re_word.findall(filename_text)
-                filename_text = (shared.opts.dataset_filename_join_string or "").join(tokens)
-        
+        self.join_string = shared.opts.dataset_filename_join_string or ""
+        self.tag_drop_out = shared.opts.tag_drop_out
+        self.shuffle_tags = shared.opts.shuffle_tags
+
+    def entry_text(self, entry):
+        # Manifest entries already hold the contents of the .txt file, if there is one.
+        if entry["caption"] is not None:
+            return entry["caption"]
+        return self.filename_text(entry["path"])
+
+    def filename_text(self, img_path):
+        filename_text = os.path.splitext(os.path.basename(img_path))[0]
+        filename_text = re.sub(self.re_numbers_at_start, '', filename_text)
+        if self.re_word:
+            tokens = self.re_word.findall(filename_text)
+            filename_text = self.join_string.join(tokens)
         return filename_text
 
     def create_text(self, text_template, filename_text):
         tags = filename_text.split(',')
-        if shared.opts.tag_drop_out != 0:
-            tags = [t for t in tags if random.random() > shared.opts.tag_drop_out]
-        if shared.opts.shuffle_tags:
+        if self.tag_drop_out != 0:
+            tags = [t for t in tags if random.random() > self.tag_drop_out]
+        if self.shuffle_tags:
             random.shuffle(tags)
         return text_template.replace("[filewords]", ','.join(tags))
 
@@ -402,110 +557,478 @@ class DreamBoothDataset(Dataset):
         hflip=False,
         use_filename_as_label=False,
         use_txt_as_label=False,
+        cache_size=None,
+        manifest_dir=None,
+        aspect_buckets=False,
     ):
         self.size = size
+        self.cache_size = cache_size or size
         self.center_crop = center_crop
         self.tokenizer = tokenizer
+        self.token_cache = TokenCache(tokenizer, pad_tokens)
         self.with_prior_preservation = with_prior_preservation
         self.pad_tokens = pad_tokens
 
+        self.use_filename_as_label = use_filename_as_label
+        self.use_txt_as_label = use_txt_as_label
+
         self.instance_images_path = []
         self.class_images_path = []
+        # The concept index of every instance and class image.
+        self.instance_concepts = []
+        self.class_concepts = []
+        # Absolute image path -> (size, mtime in ns) from the manifests, so the image caches don't stat every file.
+        self.file_stats = {}
+        self.concepts_list = concepts_list
+        self.concept_repeats = [float(concept.get("instance_repeats", 1)) for concept in concepts_list]
+        self.concept_budgets = [concept.get("step_budget") for concept in concepts_list]
         self.text_getter = FilenameTextGetter()
-        for concept in concepts_list:
-            inst_img_path = [(x, concept["instance_prompt"], self.text_getter.read_text(x)) for x in Path(concept["instance_data_dir"]).iterdir() if is_image(x)]
-            self.instance_images_path.extend(inst_img_path)
-
-            if with_prior_preservation:
-                class_img_path = [(x, concept["class_prompt"], self.text_getter.read_text(x)) for x in Path(concept["class_data_dir"]).iterdir() if is_image(x)]
-                self.class_images_path.extend(class_img_path[:num_class_images])
+        image_sizes = self.load_concepts(concepts_list, num_class_images, manifest_dir)
 
-        random.shuffle(self.instance_images_path)
+        order = list(range(len(self.instance_images_path)))
+        random.shuffle(order)
+        self.instance_images_path = [self.instance_images_path[index] for index in order]
+        self.instance_concepts = [self.instance_concepts[index] for index in order]
         self.num_instance_images = len(self.instance_images_path)
         self.num_class_images = len(self.class_images_path)
-        self._length = max(self.num_class_images, self.num_instance_images)
-        self.use_filename_as_label = use_filename_as_label
-        self.use_txt_as_label = use_txt_as_label
-
+        # An epoch is every instance image times its concept's repeats, however many class images there are. Class
+        # images are paired with instances of their own concept, picked at random for every sample.
+        self.samples = concept_samples(self.instance_concepts, self.concept_repeats)
+        sample_counts = [0] * len(concepts_list)
+        for instance_index in self.samples:
+            sample_counts[self.instance_concepts[instance_index]] += 1
+        self.concept_weights = concept_weights(concepts_list, sample_counts)
+        self.concept_classes = {}
+        for index, concept in enumerate(self.class_concepts):
+            self.concept_classes.setdefault(concept, []).append(index)
+        self._length = len(self.samples)
+
+        # Instance images are assigned the (width, height) bucket closest to their aspect ratio, and class images are
+        # cropped to the bucket of the instance image they're paired with. Without aspect_buckets, everything is square.
+        self.buckets = make_buckets(size) if aspect_buckets else [(size, size)]
+        self.instance_buckets = [closest_bucket(self.buckets, *image_sizes[path]) if aspect_buckets else 0
+                                 for path, _, _ in self.instance_images_path]
+        self.aspect_buckets = aspect_buckets
+        self.normalize = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5], [0.5])])
+
+        self.image_cache = None
+        self.flip = transforms.RandomHorizontalFlip(0.5 * hflip)
+        self.resize = transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR)
         self.image_transforms = transforms.Compose(
             [
-                transforms.RandomHorizontalFlip(0.5 * hflip),
                 transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR),
                 transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size),
                 transforms.ToTensor(),
                 transforms.Normalize([0.5], [0.5]),
             ]
         )
+        self.cache_transforms = self.image_transforms
+        if self.cache_size != size:
+            # Latents are cached at a larger size and randomly cropped to size at train time.
+            self.cache_transforms = transforms.Compose(
+                [
+                    transforms.Resize(self.cache_size, interpolation=transforms.InterpolationMode.BILINEAR),
+                    transforms.CenterCrop(self.cache_size),
+                    transforms.ToTensor(),
+                    transforms.Normalize([0.5], [0.5]),
+                ]
+            )
+
+    def load_concepts(self, concepts_list, num_class_images, manifest_dir):
+        # Fills the instance and class image lists. Returns: The (width, height) of every instance image.
+        image_sizes = {}
+        for concept_index, concept in enumerate(concepts_list):
+            # Captions are read once here, the manifest already holds the .txt contents.
+            instance_entries = load_manifest(concept["instance_data_dir"], manifest_dir)
+            inst_img_path = [self.instance_entry(x, concept) for x in instance_entries]
+            self.instance_images_path.extend(inst_img_path)
+            self.instance_concepts.extend([concept_index] * len(inst_img_path))
+            image_sizes.update((Path(x["path"]), (x["width"], x["height"])) for x in instance_entries)
+            self.file_stats.update((os.path.abspath(x["path"]), (x["size"], x["mtime"])) for x in instance_entries)
+
+            if self.with_prior_preservation:
+                class_entries = load_manifest(concept["class_data_dir"], manifest_dir)[:num_class_images]
+                class_img_path = [self.class_entry(x, concept) for x in class_entries]
+                self.file_stats.update((os.path.abspath(x["path"]), (x["size"], x["mtime"])) for x in class_entries)
+                self.class_images_path.extend(class_img_path)
+                self.class_concepts.extend([concept_index] * len(class_img_path))
+        return image_sizes
+
+    def concept_class_images(self, concept):
+        # A concept without class images of its own borrows those of the others.
+        return self.concept_classes.get(concept) or range(self.num_class_images)
+
+    def instance_entry(self, entry, concept):
+        return Path(entry["path"]), self.instance_label(entry, concept["instance_prompt"]), self.text_getter.entry_text(entry)
+
+    def class_entry(self, entry, concept):
+        return Path(entry["path"]), concept["class_prompt"], self.text_getter.entry_text(entry)
 
     def __len__(self):
         return self._length
 
+    def resize_image(self, image_path):
+        return self.resize(open_image(image_path, self.size))
+
+    def cache_bucket(self, bucket):
+        # The size latents of a bucket are cached at, scaled up like cache_size when latents are randomly cropped.
+        width, height = bucket
+        scale = self.cache_size / self.size
+        return int(round(width * scale / 8)) * 8, int(round(height * scale / 8)) * 8
+
+    def sample_buckets(self):
+        return [self.instance_buckets[instance_index] for instance_index in self.samples]
+
+    def sample_concepts(self):
+        return [self.instance_concepts[instance_index] for instance_index in self.samples]
+
+    def bucket_transforms(self, image, bucket, cache=False):
+        # Resize to cover the bucket, then crop the overhang. Like the square transforms, images for the latent cache
+        # are only randomly cropped when latents aren't cropped at train time.
+        width, height = self.cache_bucket(bucket) if cache else bucket
+        scale = max(width / image.width, height / image.height)
+        image = image.resize((max(width, round(image.width * scale)), max(height, round(image.height * scale))),
+                             Image.BILINEAR)
+        if self.center_crop or (cache and self.cache_size != self.size):
+            left, top = (image.width - width) // 2, (image.height - height) // 2
+        else:
+            left, top = random.randint(0, image.width - width), random.randint(0, image.height - height)
+        return self.normalize(image.crop((left, top, left + width, top + height)))
+
+    def load_image(self, image_path, flip=True, cache=False, bucket=None):
+        image = None
+        if self.image_cache is not None and not cache:
+            # Already resized, the Resize transform below is a no-op for these.
+            image = self.image_cache.get(image_path)
+        if image is None:
+            image = open_image(image_path, self.cache_size if cache else self.size)
+        if flip:
+            image = self.flip(image)
+        if self.aspect_buckets:
+            return self.bucket_transforms(image, bucket, cache)
+        return self.cache_transforms(image) if cache else self.image_transforms(image)
+
+    def instance_label(self, entry, instance_prompt):
+        if self.use_txt_as_label:
+            return entry["caption"] or ""
+        if self.use_filename_as_label:
+            return get_filename(Path(entry["path"]))
+        return instance_prompt
+
+    def get_instance_prompt(self, index):
+        instance_path, instance_prompt, instance_text = self.instance_images_path[index]
+        return self.text_getter.create_text(instance_prompt, instance_text)
+
+    def get_class_prompt(self, index):
+        class_path, class_prompt, class_text = self.class_images_path[index]
+        return self.text_getter.create_text(class_prompt, class_text)
+
+    def prompt_lengths(self):
+        """
+        Token lengths of the samples' prompts with all of their tags, for grouping samples by length. With prior
+        preservation a sample's length is that of the longer of its instance and class prompts.
+        """
+        instance_prompts = [prompt.replace("[filewords]", text) for _, prompt, text in self.instance_images_path]
+        class_prompts = [prompt.replace("[filewords]", text) for _, prompt, text in self.class_images_path]
+        instance_lengths = [len(ids) for ids in self.token_cache(instance_prompts)]
+        class_lengths = [len(ids) for ids in self.token_cache(class_prompts)]
+        concept_lengths = {}
+        lengths = []
+        for instance_index in self.samples:
+            length = instance_lengths[instance_index]
+            if self.with_prior_preservation:
+                # Any of the concept's class images can be paired with the instance, so its longest prompt counts.
+                concept = self.instance_concepts[instance_index]
+                if concept not in concept_lengths:
+                    concept_lengths[concept] = max(class_lengths[index] for index in self.concept_class_images(concept))
+                length = max(length, concept_lengths[concept])
+            lengths.append(length)
+        return lengths
+
     def __getitem__(self, index):
+        instance_index = self.samples[index]
+        bucket = self.buckets[self.instance_buckets[instance_index]]
+        concept = self.instance_concepts[instance_index]
+        class_entry = None
+        if self.with_prior_preservation:
+            class_entry = self.class_images_path[random.choice(self.concept_class_images(concept))]
+        example = self.make_example(self.instance_images_path[instance_index], class_entry, bucket)
+        example["concept"] = concept
+        return example
+
+    def make_example(self, instance_entry, class_entry=None, bucket=None):
+        start = time.perf_counter()
         example = {}
-        instance_path, instance_prompt, instance_text = self.instance_images_path[index % self.num_instance_images]
-        instance_prompt = get_filename(instance_path) if self.use_filename_as_label else instance_prompt
-        instance_prompt = get_label_from_txt(instance_path) if self.use_txt_as_label else instance_prompt
-        instance_image = Image.open(instance_path)
-        
-        # print("prompt: ", instance_prompt)
-        
-        if not instance_image.mode == "RGB":
-            instance_image = instance_image.convert("RGB")
-        example["instance_images"] = self.image_transforms(instance_image)
+        instance_path, instance_prompt, instance_text = instance_entry
+        example["instance_images"] = self.load_image(instance_path, bucket=bucket)
         example["instance_prompt"] = self.text_getter.create_text(instance_prompt, instance_text)   #TODO: show the final prompt of the image currently being trained in the ui
-        example["instance_prompt_ids"] = self.tokenizer(
-            example["instance_prompt"],
-            padding="max_length" if self.pad_tokens else "do_not_pad",
-            truncation=True,
-            max_length=self.tokenizer.model_max_length,
-        ).input_ids
 
-        if self.with_prior_preservation:
-            class_path, class_prompt, class_text = self.class_images_path[index % self.num_class_images]
-            class_image = Image.open(class_path)
-            if not class_image.mode == "RGB":
-                class_image = class_image.convert("RGB")
-            example["class_images"] = self.image_transforms(class_image)
+        # print("prompt: ", example["instance_prompt"])
+
+        if class_entry is not None:
+            class_path, class_prompt, class_text = class_entry
+            example["class_images"] = self.load_image(class_path, bucket=bucket)
             example["class_prompt"] = self.text_getter.create_text(class_prompt, class_text)
-            example["class_prompt_ids"] = self.tokenizer(
-                example["class_prompt"],
-                padding="max_length" if self.pad_tokens else "do_not_pad",
-                truncation=True,
-                max_length=self.tokenizer.model_max_length,
-            ).input_ids
 
+        example["load_time"] = time.perf_counter() - start
         return example
 
+    def collate_fn(self, examples):
+        prompts = [example["instance_prompt"] for example in examples]
+        pixel_values = [example["instance_images"] for example in examples]
 
-class PromptDataset(Dataset):
-    "A simple dataset to prepare the prompts to generate class images on multiple GPUs."
+        # Concat class and instance examples for prior preservation.
+        # We do this to avoid doing two forward passes.
+        if self.with_prior_preservation:
+            prompts += [example["class_prompt"] for example in examples]
+            pixel_values += [example["class_images"] for example in examples]
 
-    def __init__(self, prompt, filename_texts, num_samples):
-        self.prompt = prompt
-        self.filename_texts = filename_texts
-        self.num_samples = num_samples
+        pixel_values = torch.stack(pixel_values)
+        pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
 
-    def __len__(self):
-        return self.num_samples
+        # The whole batch is tokenized at once, padded to its longest prompt.
+        input_ids = self.token_cache.pad(self.token_cache(prompts))
 
-    def __getitem__(self, index):
-        example = {}
-        example["filename_text"] = self.filename_texts[index % len(self.filename_texts)] if len(self.filename_texts) > 0 else ""
-        example["prompt"] = self.prompt.replace("[filewords]", example["filename_text"])
-        example["index"] = index
-        return example
+        batch = {
+            "input_ids": input_ids,
+            "pixel_values": pixel_values,
+            "concepts": torch.tensor([example["concept"] for example in examples], dtype=torch.long),
+            "load_time": sum(example["load_time"] for example in examples),
+        }
+        return batch
+
+
+class StreamingDreamBoothDataset(DreamBoothDataset, IterableDataset):
+    """
+    DreamBoothDataset that streams images from the directory manifests instead of holding every path in memory.
+
+    Manifests are read one line at a time, and every accelerate process and dataloader worker only reads its own shard
+    of the lines (line number modulo the number of shards), so the split is deterministic. Order is randomized through
+    a shuffle buffer of shuffle_buffer entries. Every shard yields the same number of samples, cycling its instance and
+    class streams until it's reached. Each concept is streamed separately, samples pick a concept in proportion to its
+    images times its repeats and pair it with a class image of the same concept.
+    """
+
+    def __init__(self, *args, shuffle_buffer=1000, num_processes=1, process_index=0, num_workers=0, batch_size=1,
+                 **kwargs):
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.num_processes = num_processes
+        self.process_index = process_index
+        self.num_workers = max(1, num_workers)
+        self.epoch = 0
+        super().__init__(*args, **kwargs)
+        self.num_instance_images = sum(count for _, _, _, count in self.instance_manifests)
+        self.num_class_images = sum(count for _, _, _, count in self.class_manifests)
+        sample_counts = [count * repeats for (_, _, _, count), repeats in
+                         zip(self.instance_manifests, self.concept_repeats)]
+        # Concepts without images can't be drawn, whatever their weight.
+        self.concept_weights = [weight if count else 0 for weight, count in
+                                zip(concept_weights(self.concepts_list, sample_counts), sample_counts)]
+        epoch_samples = sum(max(1, round(count)) for count in sample_counts if count)
+        samples = math.ceil(epoch_samples / (num_processes * self.num_workers))
+        # Workers batch their own samples, whole batches per worker keep len() of the dataloader exact.
+        self.samples_per_shard = math.ceil(samples / batch_size) * batch_size
+        self._length = self.samples_per_shard * self.num_workers
+
+    def load_concepts(self, concepts_list, num_class_images, manifest_dir):
+        # Only the manifest files and their sizes are kept, entries are read while iterating.
+        self.instance_manifests = []
+        self.class_manifests = []
+        for concept in concepts_list:
+            file = update_manifest(concept["instance_data_dir"], manifest_dir)
+            self.instance_manifests.append((file, concept["instance_data_dir"], concept, read_header(file)["count"]))
+            if self.with_prior_preservation:
+                file = update_manifest(concept["class_data_dir"], manifest_dir)
+                count = read_header(file)["count"]
+                if num_class_images is not None:
+                    count = min(count, num_class_images)
+                self.class_manifests.append((file, concept["class_data_dir"], concept, count))
+        return {}
+
+    def stream(self, manifests, make_entry, shard, num_shards, rng):
+        # An endless shuffled stream of the shard's entries, restarting once every entry was read.
+        while True:
+            buffer = []
+            for file, data_dir, concept, count in manifests:
+                # With fewer images than shards, every shard reads all of them.
+                concept_shard, concept_shards = (shard, num_shards) if count >= num_shards else (0, 1)
+                for entry in iter_manifest(file, data_dir, concept_shard, concept_shards, count):
+                    buffer.append(make_entry(entry, concept))
+                    if len(buffer) >= self.shuffle_buffer:
+                        index = rng.randrange(len(buffer))
+                        buffer[index], buffer[-1] = buffer[-1], buffer[index]
+                        yield buffer.pop()
+            rng.shuffle(buffer)
+            yield from buffer
+            if not any(count for _, _, _, count in manifests):
+                return
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        shard = self.process_index * self.num_workers + worker_id
+        num_shards = self.num_processes * self.num_workers
+        # Persistent workers keep the seed they were created with, the epoch (counted on the worker's copy) is mixed in
+        # so every epoch draws a different order.
+        seed = worker_info.seed if worker_info is not None else torch.initial_seed()
+        rng = random.Random(seed + self.epoch)
+        self.epoch += 1
+        instances = [self.stream([manifest], self.instance_entry, shard, num_shards, rng)
+                     for manifest in self.instance_manifests]
+        classes = []
+        if self.with_prior_preservation:
+            # A concept without class images of its own borrows those of the others.
+            all_classes = self.stream(self.class_manifests, self.class_entry, shard, num_shards, rng)
+            classes = [self.stream([manifest], self.class_entry, shard, num_shards, rng) if manifest[3] else all_classes
+                       for manifest in self.class_manifests]
+        concepts = range(len(instances))
+        for _ in range(self.samples_per_shard):
+            concept = rng.choices(concepts, self.concept_weights)[0]
+            example = self.make_example(next(instances[concept]), next(classes[concept]) if classes else None)
+            example["concept"] = concept
+            yield example
 
 
 class LatentsDataset(Dataset):
-    def __init__(self, latents_cache, text_encoder_cache):
-        self.latents_cache = latents_cache
+    """
+    Serves cached latents per sample, so batches are drawn at random every epoch instead of being fixed at caching time.
+    Every instance and class image is cached once per aspect bucket it's used in, and samples pair them up the same
+    way DreamBoothDataset does, drawing a class image of the instance's concept at random for every batch.
+    Augmentation is kept by caching several variants of each entry and picking one at random for every batch.
+    """
+
+    def __init__(self, latents_caches: List[LatentStore], text_encoder_cache: LatentStore, text_lengths,
+                 latent_bucket, latent_index, text_index, text_counts, sample_entries, sample_concepts,
+                 class_pools=None, flip=False, crop_sizes=None):
+        self.latents_caches = latents_caches
         self.text_encoder_cache = text_encoder_cache
+        self.text_lengths = text_lengths
+        # Entries are instance images first, then class images. Each maps to its first row in the latents_caches store
+        # of its bucket, which is followed by the flipped latents if flip is set, and to the first text_counts[entry]
+        # prompt rows of text_index[entry]. Prompt rows are shared between entries.
+        self.latent_bucket = latent_bucket
+        self.latent_index = latent_index
+        self.text_index = text_index
+        self.text_counts = text_counts
+        # The instance entry, and the class_pools index with prior preservation, of every sample. Pools are lists of
+        # class entries.
+        self.sample_entries = sample_entries
+        self.class_pools = class_pools
+        self.concepts = torch.tensor(sample_concepts, dtype=torch.long)
+        self.flip = flip
+        # Latents cached larger than the training resolution are randomly cropped to the (height, width) of their
+        # bucket's crop_sizes for every batch.
+        self.crop_sizes = crop_sizes
 
     def __len__(self):
-        return len(self.latents_cache)
+        return len(self.sample_entries)
+
+    def random_crop(self, latents, crop_size):
+        height, width = latents.shape[-2:]
+        if crop_size is None or (height, width) == crop_size:
+            return latents
+        crop_height, crop_width = crop_size
+        crops = []
+        for latent in latents:
+            top = random.randint(0, height - crop_height)
+            left = random.randint(0, width - crop_width)
+            crops.append(latent[:, top:top + crop_height, left:left + crop_width])
+        return torch.stack(crops)
+
+    def sample_buckets(self):
+        return [int(self.latent_bucket[entries[0]]) for entries in self.sample_entries]
+
+    def sample_concepts(self):
+        return self.concepts.tolist()
+
+    def prompt_lengths(self):
+        # The longest cached caption of each sample's instance entry and class pool, for grouping samples by length.
+        entry_lengths = [int(self.text_lengths[rows[:count]].max())
+                         for rows, count in zip(self.text_index, self.text_counts.tolist())]
+        pool_lengths = [max(entry_lengths[entry] for entry in pool) for pool in self.class_pools or []]
+        lengths = []
+        for sample in self.sample_entries:
+            length = entry_lengths[sample[0]]
+            if len(sample) > 1:
+                length = max(length, pool_lengths[sample[1]])
+            lengths.append(length)
+        return lengths
 
     def __getitem__(self, index):
-        return self.latents_cache[index], self.text_encoder_cache[index]
+        return index
+
+    def collate_fn(self, indices):
+        samples = [self.sample_entries[index] for index in indices]
+        # Instance entries go first and class entries second, matching how the training loop chunks prior preservation.
+        entries = [sample[0] for sample in samples] + [random.choice(self.class_pools[sample[1]])
+                                                       for sample in samples if len(sample) > 1]
+        entries = torch.tensor(entries, dtype=torch.long)
+        # The batch sampler only puts samples of the same bucket in a batch.
+        bucket = int(self.latent_bucket[entries[0]])
+        latent_rows = self.latent_index[entries]
+        if self.flip:
+            latent_rows = latent_rows + torch.randint(0, 2, latent_rows.shape)
+        text_counts = self.text_counts[entries]
+        variants = (torch.rand(text_counts.shape) * text_counts).long()
+        text_rows = self.text_index[entries, variants]
+        # Text states are cached at full length, the CLIP causal mask makes this prefix equal to padding to longest.
+        length = int(self.text_lengths[text_rows].max())
+        crop_size = self.crop_sizes[bucket] if self.crop_sizes is not None else None
+        latents = self.random_crop(self.latents_caches[bucket].get(latent_rows), crop_size)
+        return latents, self.text_encoder_cache.get(text_rows)[:, :length], self.concepts[indices]
+
+
+class ThroughputMeter:
+    """
+    Compares how many images per second the input pipeline can deliver with how many the training steps consume.
+    """
+
+    def __init__(self, num_workers=0):
+        self.num_workers = max(1, num_workers)
+        self.reset()
+
+    def reset(self):
+        self.images = 0
+        self.load_time = self.wait_time = self.step_time = 0.0
+
+    def update(self, images, load_time, wait_time, step_time):
+        self.images += images
+        self.load_time += load_time
+        self.wait_time += wait_time
+        self.step_time += step_time
+
+    def logs(self):
+        logs = {}
+        if self.step_time > 0:
+            logs["step_img_s"] = self.images / self.step_time
+            logs["data_wait"] = self.wait_time / (self.wait_time + self.step_time)
+        if self.load_time > 0:
+            # Workers load in parallel, so the pipeline can deliver num_workers times the rate of a single loader.
+            logs["data_img_s"] = self.images * self.num_workers / self.load_time
+        return logs
+
+
+class ConceptLossMeter:
+    """
+    The mean instance loss of every concept since the last reset. Sums stay on the device, so steps don't wait on it.
+    """
+
+    def __init__(self, num_concepts, device):
+        self.sums = torch.zeros(num_concepts, device=device)
+        self.counts = torch.zeros(num_concepts, device=device)
+
+    def reset(self):
+        self.sums.zero_()
+        self.counts.zero_()
+
+    def update(self, concepts, losses):
+        concepts = concepts.to(self.sums.device)
+        self.sums.index_add_(0, concepts, losses.float())
+        self.counts.index_add_(0, concepts, torch.ones_like(losses, dtype=torch.float))
+
+    def logs(self):
+        return {f"loss_concept_{concept}": total / count
+                for concept, (total, count) in enumerate(zip(self.sums.tolist(), self.counts.tolist())) if count}
 
 
 class AverageMeter:
@@ -620,69 +1143,14 @@ def main(args):
             }
         ]
 
+    manifest_dir = os.path.join(args.output_dir, "manifests")
     if args.with_prior_preservation:
-        pipeline = None
-        text_getter = FilenameTextGetter()
-        for concept in args.concepts_list:
-            class_images_dir = Path(concept["class_data_dir"])
-            class_images_dir.mkdir(parents=True, exist_ok=True)
-            cur_class_images = len(list(class_images_dir.iterdir()))
-
-            if cur_class_images < args.num_class_images:
-                shared.state.textinfo = f"Generating class images for training..."
-                torch_dtype = torch.float16 if accelerator.device.type == "cuda" else torch.float32
-                if pipeline is None:
-                    pipeline = StableDiffusionPipeline.from_pretrained(
-                        args.working_dir,
-                        vae=AutoencoderKL.from_pretrained(
-                            args.pretrained_vae_name_or_path or args.working_dir,
-                            subfolder=None if args.pretrained_vae_name_or_path else "vae",
-                            torch_dtype=torch_dtype
-                        ),
-                        torch_dtype=torch_dtype,
-                        safety_checker=None
-                    )
-                    pipeline.set_progress_bar_config(disable=True)
-                    pipeline.to(accelerator.device)
-
-                num_new_images = args.num_class_images - cur_class_images
-                print(f"Number of class images to sample: {num_new_images}.")
-                shared.state.job_count = num_new_images
-                shared.state.job_no = 0
-                save_txt = "[filewords]" in concept["class_prompt"]
-                filename_texts = [text_getter.read_text(x) for x in Path(concept["instance_data_dir"]).iterdir() if is_image(x)]
-                sample_dataset = PromptDataset(concept["class_prompt"], filename_texts, num_new_images)
-                sample_dataloader = torch.utils.data.DataLoader(sample_dataset, batch_size=args.sample_batch_size)
-
-                sample_dataloader = accelerator.prepare(sample_dataloader)
-
-                with torch.autocast("cuda"), torch.inference_mode():
-                    for example in tqdm(
-                            sample_dataloader, desc="Generating class images",
-                            disable=not accelerator.is_local_main_process
-                    ):
-                        images = pipeline(example["prompt"]).images
-
-                        for i, image in enumerate(images):
-                            shared.state.job_no += 1
-                            hash_image = hashlib.sha1(image.tobytes()).hexdigest()
-                            image_filename = class_images_dir / f"{example['index'][i] + cur_class_images}-{hash_image}.jpg"
-                            shared.state.current_image = image
-                            image.save(image_filename)
-                            if save_txt:
-                                txt_filename = class_images_dir / f"{example['index'][i] + cur_class_images}-{hash_image}.txt"
-                                with open(txt_filename, "w", encoding="utf8") as file:
-                                    # we have to write filename_text and not full prompt here, otherwise "dog, [filewords]" becomes "dog, dog, [filewords]" when read. Any elegant solution?
-                                    file.write(example["filename_text"][i] + "\n")
-
-        del pipeline
-        del text_getter
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        if generate_class_images(args, accelerator, manifest_dir, FilenameTextGetter()):
+            return 0
 
     # Load the tokenizer
 
-    tokenizer = CLIPTokenizer.from_pretrained(os.path.join(args.working_dir, "tokenizer"))
+    tokenizer = load_tokenizer(os.path.join(args.working_dir, "tokenizer"))
     # Load models and create wrapper for stable diffusion
     text_encoder = CLIPTextModel.from_pretrained(os.path.join(args.working_dir, "text_encoder"))
     vae = AutoencoderKL.from_pretrained(os.path.join(args.working_dir, "vae"))
@@ -731,7 +1199,30 @@ def main(args):
 
     noise_scheduler = DDPMScheduler.from_config(os.path.join(args.working_dir, "scheduler"))
 
-    train_dataset = DreamBoothDataset(
+    cache_size = args.resolution
+    if not args.not_cache_latents and not args.center_crop and args.latent_crop_scale > 1:
+        cache_size = int(round(args.resolution * args.latent_crop_scale / 8)) * 8
+
+    num_workers = int(args.dataloader_workers or 0)
+    # Latent caching needs every image up front, so only uncached runs can stream.
+    streaming = args.streaming_dataset and args.not_cache_latents
+    dataset_class = DreamBoothDataset
+    dataset_kwargs = {"aspect_buckets": args.aspect_buckets}
+    if args.streaming_dataset and not streaming:
+        print("The streaming dataset needs \"Don't Cache Latents\", loading the dataset into memory.")
+    if streaming:
+        if args.aspect_buckets:
+            print("Aspect ratio buckets aren't supported by the streaming dataset, training square images.")
+        dataset_class = StreamingDreamBoothDataset
+        dataset_kwargs = {
+            "shuffle_buffer": args.shuffle_buffer,
+            "num_processes": accelerator.num_processes,
+            "process_index": accelerator.process_index,
+            "num_workers": num_workers,
+            "batch_size": args.train_batch_size,
+        }
+
+    train_dataset = dataset_class(
         concepts_list=args.concepts_list,
         tokenizer=tokenizer,
         with_prior_preservation=args.with_prior_preservation,
@@ -742,35 +1233,52 @@ def main(args):
         hflip=args.hflip,
         use_filename_as_label=args.use_filename_as_label,
         use_txt_as_label=args.use_txt_as_label,
+        cache_size=cache_size,
+        manifest_dir=manifest_dir,
+        **dataset_kwargs,
     )
 
-    def collate_fn(examples):
-        input_ids = [example["instance_prompt_ids"] for example in examples]
-        pixel_values = [example["instance_images"] for example in examples]
-
-        # Concat class and instance examples for prior preservation.
-        # We do this to avoid doing two forward passes.
-        if args.with_prior_preservation:
-            input_ids += [example["class_prompt_ids"] for example in examples]
-            pixel_values += [example["class_images"] for example in examples]
-
-        pixel_values = torch.stack(pixel_values)
-        pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-
-        input_ids = tokenizer.pad(
-            {"input_ids": input_ids},
-            padding=True,
-            return_tensors="pt",
-        ).input_ids
-
-        batch = {
-            "input_ids": input_ids,
-            "pixel_values": pixel_values,
+    if args.not_cache_latents and args.cache_resized_images and not streaming:
+        image_cache = ImageShardCache(os.path.join(args.output_dir, "image_cache"), args.resolution)
+        image_paths = [entry[0] for entry in train_dataset.instance_images_path + train_dataset.class_images_path]
+        image_cache.build(image_paths, train_dataset.resize_image, train_dataset.file_stats)
+        train_dataset.image_cache = image_cache
+
+    # Workers decode, resize and tokenize images off the training thread.
+    dataloader_kwargs = {}
+    if num_workers > 0:
+        dataloader_kwargs = {
+            "num_workers": num_workers,
+            "prefetch_factor": args.dataloader_prefetch_factor,
+            "persistent_workers": args.dataloader_persistent_workers,
         }
-        return batch
 
+    # Concepts are interleaved by weight instead of image count once any of them sets a weight or step budget.
+    sample_weights = train_dataset.concept_weights
+    concept_budgets = train_dataset.concept_budgets
+    balance_concepts = any("sample_weight" in concept or "step_budget" in concept for concept in args.concepts_list)
+    if streaming and any(budget is not None for budget in concept_budgets):
+        print("Concept step budgets aren't supported by the streaming dataset, only sample weights are used.")
+
+    def batch_kwargs(dataset, group_lengths=True):
+        # Images of different buckets can't be stacked, so batches are drawn from one bucket at a time. Otherwise,
+        # without pad_tokens, batches are grouped by prompt length so short prompts aren't padded to long ones.
+        if isinstance(dataset, IterableDataset):
+            return {"batch_size": args.train_batch_size}
+        if balance_concepts:
+            buckets = dataset.sample_buckets() if args.aspect_buckets else None
+            return {"batch_sampler": ConceptBatchSampler(dataset.sample_concepts(), args.train_batch_size,
+                                                         sample_weights, concept_budgets, buckets)}
+        if args.aspect_buckets and args.train_batch_size > 1:
+            return {"batch_sampler": BucketBatchSampler(dataset.sample_buckets(), args.train_batch_size)}
+        if not group_lengths or args.pad_tokens or args.train_batch_size < 2:
+            return {"batch_size": args.train_batch_size, "shuffle": True}
+        return {"batch_sampler": LengthGroupedBatchSampler(dataset.prompt_lengths(), args.train_batch_size)}
+
+    # When latents are cached, this loader is replaced after caching.
     train_dataloader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.train_batch_size, shuffle=True, collate_fn=collate_fn, pin_memory=True
+        train_dataset, collate_fn=train_dataset.collate_fn, pin_memory=True,
+        **batch_kwargs(train_dataset, args.not_cache_latents), **dataloader_kwargs
     )
 
     weight_dtype = torch.float32
@@ -787,21 +1295,169 @@ def main(args):
         text_encoder.to(accelerator.device)
 
     if not args.not_cache_latents:
-        latents_cache = []
-        text_encoder_cache = []
-        for batch in tqdm(train_dataloader, desc="Caching latents"):
+        disk_cache = None
+        if args.cache_latents_to_disk:
+            crop_mode = "center" if args.center_crop else "random" if cache_size == args.resolution else "latent"
+            transform_key = f"{cache_size}-{crop_mode}"
+            disk_cache = LatentCache(os.path.join(args.output_dir, "latent_cache"),
+                                     os.path.join(args.working_dir, "vae"), transform_key, train_dataset.file_stats)
+
+        def encode_vae(pixel_values):
+            pixel_values = pixel_values.to(accelerator.device, non_blocking=True, dtype=weight_dtype)
+            return vae.encode(pixel_values).latent_dist.parameters
+
+        # Caching isn't bound by the training batch size, the VAE gets as many images as fit in memory.
+        cache_batch_size = args.cache_batch_size or estimate_encode_batch_size(cache_size, accelerator.device,
+                                                                               weight_dtype)
+        encode_latents = BatchedEncoder(encode_vae, cache_batch_size)
+        print(f"Caching latents {cache_batch_size} images at a time.")
+
+        # Each unique image is encoded once per bucket, instance and class images are paired up again when sampling.
+        # Class images are cropped to the bucket of the instance image they're paired with, so they get an entry per
+        # bucket they're used in.
+        num_variants = max(1, args.cache_caption_variants)
+        entries = [(entry[0], train_dataset.instance_buckets[index],
+                    [train_dataset.get_instance_prompt(index) for _ in range(num_variants)])
+                   for index, entry in enumerate(train_dataset.instance_images_path)]
+        num_instance_entries = len(entries)
+        # Samples draw their class image from a pool per concept and bucket. A pool only gets as many of the concept's
+        # class images as its samples can use over the whole run, so unused class images aren't encoded.
+        samples_per_step = args.train_batch_size * args.gradient_accumulation_steps * accelerator.num_processes
+        run_epochs = args.num_train_epochs
+        if args.max_train_steps:
+            run_epochs = math.ceil(args.max_train_steps * samples_per_step / len(train_dataset))
+        pool_samples = {}
+        if train_dataset.num_class_images:
+            for instance_index in train_dataset.samples:
+                key = (train_dataset.instance_concepts[instance_index], entries[instance_index][1])
+                pool_samples[key] = pool_samples.get(key, 0) + 1
+        # Samples each pool's class images are drawn for over the run.
+        pool_draws = {key: count * run_epochs for key, count in pool_samples.items()}
+        if balance_concepts and pool_samples:
+            # Concepts are drawn by weight and budget rather than by image count, a small concept with a large weight
+            # comes up far more often than its samples. A concept's draws are split between its buckets by samples.
+            concept_counts = {}
+            for (concept, _), count in pool_samples.items():
+                concept_counts[concept] = concept_counts.get(concept, 0) + count
+            total_batches = run_epochs * math.ceil(len(train_dataset) / args.train_batch_size)
+            draws = concept_draws([weight if concept in concept_counts else 0
+                                   for concept, weight in enumerate(sample_weights)], concept_budgets, total_batches)
+            pool_draws = {(concept, bucket): math.ceil(draws[concept] * args.train_batch_size * count /
+                                                       concept_counts[concept])
+                          for (concept, bucket), count in pool_samples.items()}
+        class_entries = {}
+        class_pools = []
+        pool_ids = {}
+        # Pools of the same concept take its class images in turn, so buckets don't share the first few.
+        concept_cursors = {}
+        for (concept, bucket), count in pool_draws.items():
+            class_images = train_dataset.concept_class_images(concept)
+            pool = []
+            for _ in range(min(len(class_images), count)):
+                cursor = concept_cursors.get(concept, 0)
+                concept_cursors[concept] = cursor + 1
+                key = (class_images[cursor % len(class_images)], bucket)
+                pool.append(class_entries.setdefault(key, num_instance_entries + len(class_entries)))
+            pool_ids[(concept, bucket)] = len(class_pools)
+            class_pools.append(pool)
+        sample_entries = []
+        for instance_index in train_dataset.samples:
+            if not class_pools:
+                sample_entries.append((instance_index,))
+                continue
+            key = (train_dataset.instance_concepts[instance_index], entries[instance_index][1])
+            sample_entries.append((instance_index, pool_ids[key]))
+        entries += [(train_dataset.class_images_path[class_index][0], bucket,
+                     [train_dataset.get_class_prompt(class_index) for _ in range(num_variants)])
+                    for class_index, bucket in class_entries]
+        unique_images = list(dict.fromkeys((image_path, bucket) for image_path, bucket, _ in entries))
+        num_flips = 2 if args.hflip else 1
+        # The caches stay in host memory instead of taking VRAM for the whole run, batches are gathered from them and
+        # copied to the device ahead of use by the prefetcher. Each bucket has its own store, as latent sizes differ.
+        latents_caches = [LatentStore(sum(bucket == index for _, bucket in unique_images) * num_flips,
+                                      dtype=LATENT_CACHE_DTYPES[args.latent_cache_dtype])
+                          for index in range(len(train_dataset.buckets))]
+        quantization_report = QuantizationReport()
+        latent_rows = {}
+
+        # Flipped variants are encoded alongside their image, so each step loads cache_batch_size // num_flips images.
+        load_batch_size = max(1, cache_batch_size // num_flips)
+        progress = tqdm(total=len(unique_images), desc="Caching latents")
+        for bucket, latents_cache in enumerate(latents_caches):
+            bucket_paths = [image_path for image_path, image_bucket in unique_images if image_bucket == bucket]
+            # Disk cache entries of non-square buckets are told apart by their size.
+            cache_width, cache_height = train_dataset.cache_bucket(train_dataset.buckets[bucket])
+            variant = f"{cache_width}x{cache_height}" if args.aspect_buckets else ""
+
+            def load_unflipped(image_path):
+                return train_dataset.load_image(image_path, flip=False, cache=True,
+                                                bucket=train_dataset.buckets[bucket])
+
+            for start in range(0, len(bucket_paths), load_batch_size):
+                image_paths = bucket_paths[start:start + load_batch_size]
+                with torch.no_grad():
+                    if disk_cache is not None:
+                        params = disk_cache.get_or_encode(image_paths, load_unflipped, encode_latents, flip=args.hflip,
+                                                          variant=variant)
+                    else:
+                        pixel_values = torch.stack([load_unflipped(image_path) for image_path in image_paths])
+                        if args.hflip:
+                            pixel_values = torch.stack([pixel_values, torch.flip(pixel_values, dims=[-1])], dim=1)
+                        params = encode_latents(pixel_values.flatten(0, 1) if args.hflip else pixel_values)
+                    params = params.reshape(len(image_paths) * num_flips, *params.shape[-3:])
+                    quantization_report.update(params)
+                    rows = latents_cache.add(params)
+                latent_rows.update(zip(((image_path, bucket) for image_path in image_paths), rows[::num_flips]))
+                progress.update(len(image_paths))
+        progress.close()
+        latent_bucket = torch.tensor([bucket for _, bucket, _ in entries], dtype=torch.long)
+        latent_index = torch.tensor([latent_rows[(image_path, bucket)] for image_path, bucket, _ in entries],
+                                    dtype=torch.long)
+
+        # Every unique prompt is encoded once. Most entries share their instance or class prompt, and shuffled or
+        # dropped-out [filewords] tags give each entry up to num_variants prompts, all referenced by id.
+        prompt_rows = {}
+        text_index = torch.zeros(len(entries), num_variants, dtype=torch.long)
+        text_counts = torch.empty(len(entries), dtype=torch.long)
+        for index, (_, _, prompts) in enumerate(entries):
+            prompts = list(dict.fromkeys(prompts))
+            text_index[index, :len(prompts)] = torch.tensor([prompt_rows.setdefault(prompt, len(prompt_rows))
+                                                             for prompt in prompts])
+            text_counts[index] = len(prompts)
+        captions = list(prompt_rows)
+
+        # Hidden states are stored in fp16, input_ids for training the text encoder stay long.
+        text_encoder_cache = LatentStore(len(captions), dtype=None if args.train_text_encoder else torch.float16)
+        text_lengths = torch.empty(len(captions), dtype=torch.long)
+        for start in range(0, len(captions), cache_batch_size):
+            prompt_ids = train_dataset.token_cache(captions[start:start + cache_batch_size])
+            input_ids = train_dataset.token_cache.pad(prompt_ids, tokenizer.model_max_length)
+            input_ids = input_ids.to(accelerator.device, non_blocking=True)
             with torch.no_grad():
-                batch["pixel_values"] = batch["pixel_values"].to(accelerator.device, non_blocking=True,
-                                                                 dtype=weight_dtype)
-                batch["input_ids"] = batch["input_ids"].to(accelerator.device, non_blocking=True)
-                latents_cache.append(vae.encode(batch["pixel_values"]).latent_dist)
                 if args.train_text_encoder:
-                    text_encoder_cache.append(batch["input_ids"])
+                    rows = text_encoder_cache.add(input_ids)
                 else:
-                    text_encoder_cache.append(encode_hidden_state(text_encoder, batch["input_ids"]))
-        train_dataset = LatentsDataset(latents_cache, text_encoder_cache)
-        train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=1, collate_fn=lambda x: x,
-                                                       shuffle=True)
+                    rows = text_encoder_cache.add(encode_hidden_state(text_encoder, input_ids))
+            text_lengths[rows.start:rows.stop] = torch.tensor([len(ids) for ids in prompt_ids])
+        if disk_cache is not None:
+            # Other processes may still be writing entries, including temporary files prune() would remove.
+            accelerator.wait_for_everyone()
+            removed = disk_cache.prune() if accelerator.is_main_process else 0
+            disk_cache.flush()
+            print(f"Latent cache: {disk_cache.hits} images loaded from disk, {disk_cache.misses} encoded, "
+                  f"{removed} unused entries removed.")
+        print(f"Cached {len(unique_images)} images as {args.latent_cache_dtype}, latents use "
+              f"{sum(cache.nbytes() for cache in latents_caches) / 1024 ** 2:.1f}MB. "
+              f"Size and error per latent_cache_dtype:\n"
+              f"{quantization_report.summary()}")
+        print(f"Cached {len(captions)} unique prompts, text states use {text_encoder_cache.nbytes() / 1024 ** 2:.1f}MB.")
+        crop_sizes = [(height // 8, width // 8) for width, height in train_dataset.buckets]
+        train_dataset = LatentsDataset(latents_caches, text_encoder_cache, text_lengths, latent_bucket, latent_index,
+                                       text_index, text_counts, sample_entries, train_dataset.sample_concepts(),
+                                       class_pools, flip=args.hflip, crop_sizes=crop_sizes)
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset, collate_fn=train_dataset.collate_fn, pin_memory=True, **batch_kwargs(train_dataset)
+        )
 
         del vae
         vae = None
@@ -817,6 +1473,12 @@ def main(args):
     if args.max_train_steps is None:
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
         overrode_max_train_steps = True
+    if balance_concepts and not streaming and all(budget is not None for budget in concept_budgets):
+        # Training stops once every concept is out of steps.
+        budget_steps = sum(int(budget) for budget in concept_budgets)
+        if budget_steps < args.max_train_steps:
+            args.max_train_steps = budget_steps
+            overrode_max_train_steps = False
 
     lr_scheduler = get_scheduler(
         args.lr_scheduler,
@@ -825,6 +1487,7 @@ def main(args):
         num_training_steps=args.max_train_steps * args.gradient_accumulation_steps,
     )
     printm("Scheduler Loaded")
+    train_dataloader_unprepared = train_dataloader
     if args.train_text_encoder and text_encoder is not None:
         unet, text_encoder, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
             unet, text_encoder, optimizer, train_dataloader, lr_scheduler
@@ -833,6 +1496,18 @@ def main(args):
         unet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
             unet, optimizer, train_dataloader, lr_scheduler
         )
+    if streaming or (args.prefetch_batches > 0 and accelerator.num_processes == 1):
+        # The streaming dataset shards itself across processes, accelerate would split its batches again. And
+        # accelerate's dataloader flags the end of the epoch for accelerator.accumulate when it yields its last batch,
+        # which the prefetch thread does batches ahead of the training step. The prefetcher reads the plain dataloader
+        # and moves its batches to the device instead.
+        train_dataloader = train_dataloader_unprepared
+    elif args.prefetch_batches > 0 and args.gradient_accumulation_steps > 1:
+        # Multiple processes need accelerate's sharding of the dataloader.
+        print("Batch prefetching is disabled for gradient accumulation on multiple processes.")
+        args.prefetch_batches = 0
+    if args.prefetch_batches > 0 or streaming:
+        train_dataloader = BatchPrefetcher(train_dataloader, accelerator.device, max(1, args.prefetch_batches))
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -926,18 +1601,22 @@ def main(args):
     shared.state.job_no = global_step
     shared.state.textinfo = f"Training step: {global_step}/{args.max_train_steps}"
     loss_avg = AverageMeter()
+    concept_loss = ConceptLossMeter(len(args.concepts_list), accelerator.device) if len(args.concepts_list) > 1 else None
+    throughput = ThroughputMeter(num_workers if args.not_cache_latents else 0)
     text_enc_context = nullcontext() if args.train_text_encoder else torch.no_grad()
     for epoch in range(args.num_train_epochs):
         try:
             unet.train()
             if args.train_text_encoder and text_encoder is not None:
                 text_encoder.train()
+            step_end = time.perf_counter()
             for step, batch in enumerate(train_dataloader):
+                step_start = time.perf_counter()
                 with accelerator.accumulate(unet):
                     # Convert images to latent space
                     with torch.no_grad():
                         if not args.not_cache_latents:
-                            latent_dist = batch[0][0]
+                            latent_dist = DiagonalGaussianDistribution(batch[0].to(dtype=weight_dtype))
                         else:
                             latent_dist = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist
                         latents = latent_dist.sample() * 0.18215
@@ -957,9 +1636,9 @@ def main(args):
                     with text_enc_context:
                         if not args.not_cache_latents:
                             if args.train_text_encoder:
-                                encoder_hidden_states = encode_hidden_state(text_encoder, batch[0][1])
+                                encoder_hidden_states = encode_hidden_state(text_encoder, batch[1])
                             else:
-                                encoder_hidden_states = batch[0][1]
+                                encoder_hidden_states = batch[1].to(dtype=weight_dtype)
                         else:
                             encoder_hidden_states = encode_hidden_state(text_encoder, batch["input_ids"])
 
@@ -972,7 +1651,8 @@ def main(args):
                         noise, noise_prior = torch.chunk(noise, 2, dim=0)
 
                         # Compute instance loss
-                        loss = F.mse_loss(noise_pred.float(), noise.float(), reduction="none").mean([1, 2, 3]).mean()
+                        instance_loss = F.mse_loss(noise_pred.float(), noise.float(), reduction="none").mean([1, 2, 3])
+                        loss = instance_loss.mean()
 
                         # Compute prior loss
                         prior_loss = F.mse_loss(noise_pred_prior.float(), noise_prior.float(), reduction="mean")
@@ -980,7 +1660,8 @@ def main(args):
                         # Add the prior loss to the instance loss.
                         loss = loss + args.prior_loss_weight * prior_loss
                     else:
-                        loss = F.mse_loss(noise_pred.float(), noise.float(), reduction="mean")
+                        instance_loss = F.mse_loss(noise_pred.float(), noise.float(), reduction="none").mean([1, 2, 3])
+                        loss = instance_loss.mean()
 
                     accelerator.backward(loss)
                     # if accelerator.sync_gradients:
@@ -994,9 +1675,18 @@ def main(args):
                     lr_scheduler.step()
                     optimizer.zero_grad(set_to_none=True)
                     loss_avg.update(loss.detach_(), bsz)
+                    if concept_loss is not None:
+                        concept_loss.update(batch["concepts"] if args.not_cache_latents else batch[2],
+                                            instance_loss.detach())
 
+                load_time = batch["load_time"] if args.not_cache_latents else 0
+                throughput.update(bsz, load_time, step_start - step_end, time.perf_counter() - step_start)
                 if not global_step % 10:
-                    logs = {"loss": loss_avg.avg.item(), "lr": lr_scheduler.get_last_lr()[0]}
+                    logs = {"loss": loss_avg.avg.item(), "lr": lr_scheduler.get_last_lr()[0], **throughput.logs()}
+                    throughput.reset()
+                    if concept_loss is not None:
+                        logs.update(concept_loss.logs())
+                        concept_loss.reset()
                     progress_bar.set_postfix(**logs)
                     accelerator.log(logs, step=global_step)
 
@@ -1017,6 +1707,7 @@ def main(args):
                         save_weights(lifetime_step, save_model, save_img)
 
                 shared.state.textinfo = f"Training, step {global_step}/{args.max_train_steps} current, {lifetime_step}/{args.max_train_steps + args.total_steps} lifetime"
+                step_end = time.perf_counter()
 
 
                 if training_complete:
@@ -68,6 +68,14 @@ def on_ui_tabs():
                         db_max_train_steps = gr.Number(label='Training steps', value=1000, precision=0)
                         db_train_batch_size = gr.Number(label="Batch Size", precision=0, value=1)
                         db_sample_batch_size = gr.Number(label="Class Batch Size", precision=0, value=1)
+                        db_class_scheduler = gr.Dropdown(label="Class Scheduler", value="dpm++",
+                                                         choices=["default", "ddim", "pndm", "lms", "euler", "euler_a",
+                                                                  "dpm++"])
+                        db_class_infer_steps = gr.Number(label="Class Generation Steps", value=20, min=1, max=200,
+                                                         precision=0)
+                        db_class_guidance_scale = gr.Number(label="Class Guidance Scale", value=7.5, max=12, min=1,
+                                                            precision=2)
+                        db_class_negative_prompt = gr.Textbox(label="Class Negative Prompt")
                         db_learning_rate = gr.Number(label='Learning rate', value=5e-6)
                         db_resolution = gr.Number(label="Resolution", precision=0, value=512)
                         db_save_embedding_every = gr.Number(
@@ -111,6 +119,7 @@ def on_ui_tabs():
                                 db_lr_warmup_steps = gr.Number(label="Warmup Steps", precision=0, value=0)
                                 db_pad_tokens = gr.Checkbox(label="Pad Tokens", value=True)
                                 db_hflip = gr.Checkbox(label="Apply horizontal Flip", value=True)
+                                db_dataloader_workers = gr.Number(label="Dataloader Workers", precision=0, value=0)
                     with gr.Row():
                         with gr.Column(scale=2):
                             gr.HTML(value="")
@@ -194,7 +203,12 @@ def on_ui_tabs():
                 db_concepts_list,
                 db_use_cpu,
                 db_pad_tokens,
-                db_hflip
+                db_hflip,
+                db_dataloader_workers,
+                db_class_scheduler,
+                db_class_infer_steps,
+                db_class_guidance_scale,
+                db_class_negative_prompt
             ],
             outputs=[
                 db_progress,
@@ -245,7 +259,12 @@ def on_ui_tabs():
                 db_concepts_list,
                 db_use_cpu,
                 db_pad_tokens,
-                db_hflip
+                db_hflip,
+                db_dataloader_workers,
+                db_class_scheduler,
+                db_class_infer_steps,
+                db_class_guidance_scale,
+                db_class_negative_prompt
             ],
             outputs=[
                 db_pretrained_vae_name_or_path,
@@ -288,6 +307,11 @@ def on_ui_tabs():
                 db_use_cpu,
                 db_pad_tokens,
                 db_hflip,
+                db_dataloader_workers,
+                db_class_scheduler,
+                db_class_infer_steps,
+                db_class_guidance_scale,
+                db_class_negative_prompt,
                 db_progress
             ]
         )